@@ -1,13 +1,23 @@
+import argparse
+import asyncio
+import json
+import logging
 import os
 import subprocess
+import time
 import webbrowser
 from enum import Enum, auto
+from pathlib import Path
 from threading import Thread
+from typing import List
 
 import prompt
+import tracing
 from anilist import AniList
-from common import Episode, ResultThread
+from cache import Cache
+from common import BackgroundService, Episode, get_root_dir
 from dotenv import load_dotenv
+from prefetch import Prefetcher
 from qbittorrent import Qbittorrent
 from reddit import Reddit
 
@@ -21,6 +31,7 @@ class State(Enum):
     OPEN_REDDIT_DISCUSSION = auto()
     OPEN_ANILIST = auto()
     DELETE_EPISODE = auto()
+    DELETE_WATCHED_EPISODES = auto()
     CLEAN_UP = auto()
 
 
@@ -28,66 +39,112 @@ class AniFlow:
 
     episode_choice: Episode
     advance_to_clean_up: bool
-    prefetch_data_thread: ResultThread
-    update_anilist_thread: ResultThread
 
     def __init__(self):
+        self.started_at = time.perf_counter()
+        self.startup_time = None
         load_dotenv()
+        self.startup_budget = float(os.getenv("STARTUP_BUDGET_SECONDS", 1))
 
-        self.qbittorrent = Qbittorrent()
-        self.reddit = Reddit()
-        self.anilist = AniList()
+        self._qbittorrent = BackgroundService(Qbittorrent)
+        self._reddit = BackgroundService(Reddit)
+        self._anilist = BackgroundService(AniList)
+        self.prefetcher = Prefetcher(
+            self.prefetch_data,
+            max_workers=int(os.getenv("PREFETCH_WORKERS", 4)),
+            is_watched=self.is_watched,
+            prepare=self.prepare_prefetch,
+            is_resolved=self.is_resolved,
+        )
 
         self.state = State.SELECT_EPISODE
 
+    @property
+    def qbittorrent(self) -> Qbittorrent:
+        return self._qbittorrent.get()
+
+    @property
+    def reddit(self) -> Reddit:
+        return self._reddit.get()
+
+    @property
+    def anilist(self) -> AniList:
+        return self._anilist.get()
+
     def start(self):
         try:
             while True:
-                match (self.state):
-                    case State.SELECT_EPISODE:
-                        self.reset()
-                        self.state = self.select_episode()
-                    case State.PLAY_VIDEO:
-                        self.state = self.play_video()
-                    case State.AUTH_ANILIST:
-                        self.state = self.auth_anilist()
-                    case State.UPDATE_ANILIST:
-                        self.state = self.update_anilist()
-                    case State.OPEN_REDDIT_DISCUSSION:
-                        self.state = self.open_reddit_discussion()
-                    case State.OPEN_ANILIST:
-                        self.state = self.open_anilist()
-                    case State.DELETE_EPISODE:
-                        self.state = self.delete_episode()
-                    case State.CLEAN_UP:
-                        self.state = self.clean_up()
-                    case _:
-                        self.state = State.SELECT_EPISODE
+                with tracing.span(self.state.name, "state"):
+                    self.handle_state()
         except KeyboardInterrupt:
             exit()
 
+    def handle_state(self):
+        match (self.state):
+            case State.SELECT_EPISODE:
+                self.reset()
+                self.state = self.select_episode()
+            case State.PLAY_VIDEO:
+                self.state = self.play_video()
+            case State.AUTH_ANILIST:
+                self.state = self.auth_anilist()
+            case State.UPDATE_ANILIST:
+                self.state = self.update_anilist()
+            case State.OPEN_REDDIT_DISCUSSION:
+                self.state = self.open_reddit_discussion()
+            case State.OPEN_ANILIST:
+                self.state = self.open_anilist()
+            case State.DELETE_EPISODE:
+                self.state = self.delete_episode()
+            case State.DELETE_WATCHED_EPISODES:
+                self.state = self.delete_watched_episodes()
+            case State.CLEAN_UP:
+                self.state = self.clean_up()
+            case _:
+                self.state = State.SELECT_EPISODE
+
     def reset(self):
         self.episode_choice = None
         self.advance_to_clean_up = False
-        self.prefetch_data_thread = None
-        self.update_anilist_thread = None
         if os.name == 'nt':
             os.system("cls")
         else:
             os.system('clear')
 
     def select_episode(self):
+        # Construct the remaining services while episodes are listed and picked
+        self._anilist.warm()
+        self._reddit.warm()
+
         reload_episodes_choice = "[Reload Episodes]"
-        choices = [reload_episodes_choice] + self.qbittorrent.get_episodes()
-        choice = prompt.list("Select an episode", choices)
+        delete_episodes_choice = "[Delete Watched Episodes]"
+        episodes = self.qbittorrent.get_episodes()
+        if self.startup_time is None:
+            self.record_startup_time()
+        self.prefetcher.submit_all(episodes)
+        choice = prompt.list(
+            "Select an episode",
+            [reload_episodes_choice, delete_episodes_choice] + episodes,
+        )
         if choice is reload_episodes_choice:
             return State.SELECT_EPISODE
+        elif choice is delete_episodes_choice:
+            return State.DELETE_WATCHED_EPISODES
         else:
             self.episode_choice = choice
-            self.prefetch_data_thread = ResultThread(target=self.prefetch_data)
-            self.prefetch_data_thread.start()
+            self.prefetcher.prioritize(choice)
             return State.PLAY_VIDEO
 
+    def record_startup_time(self):
+        self.startup_time = time.perf_counter() - self.started_at
+        if self.startup_time > self.startup_budget:
+            logging.warning(
+                f"Startup took {self.startup_time:.2f}s, "
+                f"over the budget of {self.startup_budget:.2f}s"
+            )
+        else:
+            logging.debug(f"Startup took {self.startup_time:.2f}s")
+
     def play_video(self):
         play_video = prompt.confirm("Play video?")
         if play_video:
@@ -103,15 +160,21 @@ class AniFlow:
                 "AniList requires your authorization in order to update your anime list. Proceed?"
             )
             if not proceed:
-                return State.OPEN_REDDIT_DISCUSSION
+                return (
+                    State.CLEAN_UP
+                    if self.advance_to_clean_up
+                    else State.OPEN_REDDIT_DISCUSSION
+                )
 
             self.anilist.open_authorization_page()
             access_token = prompt.password("Paste the token provided by AniList")
             self.anilist.set_access_token(access_token)
-        return State.UPDATE_ANILIST
+        # Updates rejected because of the old token are still queued and are
+        # sent with the new one, so there is nothing to update again
+        return State.CLEAN_UP if self.advance_to_clean_up else State.UPDATE_ANILIST
 
     def update_anilist(self):
-        self.prefetch_data_thread.join()
+        self.prefetcher.result(self.episode_choice)
         if not self.episode_choice.anilist_entry:
             return State.OPEN_REDDIT_DISCUSSION
 
@@ -119,20 +182,14 @@ class AniFlow:
             f'Update progress on AniList for "{self.episode_choice.anilist_entry.titles[0]}"?'
         )
         if update_anilist:
-            self.update_anilist_thread = ResultThread(
-                target=self.anilist.update_entry, args=[self.episode_choice]
-            )
-            self.update_anilist_thread.start()
+            self.anilist.update_entry(self.episode_choice)
 
-        return (
-            State.CLEAN_UP if self.advance_to_clean_up else State.OPEN_REDDIT_DISCUSSION
-        )
+        return State.OPEN_REDDIT_DISCUSSION
 
     def open_reddit_discussion(self):
         open_reddit_discussion = prompt.confirm("Open r/anime discussion thread?")
         if open_reddit_discussion:
-            self.prefetch_data_thread.join()
-            reddit_discussion = self.prefetch_data_thread.result
+            reddit_discussion = self.prefetcher.result(self.episode_choice)
             if reddit_discussion:
                 Thread(target=reddit_discussion.upvote).start()
                 url = reddit_discussion.url
@@ -154,21 +211,230 @@ class AniFlow:
             self.qbittorrent.delete(self.episode_choice)
         return State.CLEAN_UP
 
+    def delete_watched_episodes(self):
+        episodes = self.qbittorrent.get_episodes()
+        # Waited for so that the watched episodes can be preselected
+        self._anilist.get()
+        selected = prompt.checkbox(
+            "Select episodes to delete",
+            episodes,
+            default=[episode for episode in episodes if self.is_watched(episode)],
+        )
+        if selected and prompt.confirm(
+            f"Delete {len(selected)} episodes?", default=False
+        ):
+            self.qbittorrent.delete_many(selected)
+        return State.SELECT_EPISODE
+
     def clean_up(self):
-        if self.update_anilist_thread:
-            self.update_anilist_thread.join()
-            encountered_auth_error = self.update_anilist_thread.result
-            self.update_anilist_thread = None
-            if encountered_auth_error:
-                self.advance_to_clean_up = True
-                return State.AUTH_ANILIST
+        # Progress updates are sent in the background, so this reports an Auth
+        # error from any update sent since the last check. It is only reported
+        # once so that declining to authorize leads back to the episode list.
+        if self.anilist.encountered_auth_error:
+            self.anilist.encountered_auth_error = False
+            self.advance_to_clean_up = True
+            return State.AUTH_ANILIST
 
         return State.SELECT_EPISODE
 
-    def prefetch_data(self):
-        self.anilist.update_episode_with_anilist_data(self.episode_choice)
-        return self.reddit.find_discussion(self.episode_choice)
+    def list_episodes(self, as_json=False):
+        episodes = self.qbittorrent.get_episodes()
+        if as_json:
+            asyncio.run(self.anilist.update_episodes_with_anilist_data(episodes))
+            print(json.dumps([self.get_episode_details(e) for e in episodes], indent=2))
+        else:
+            for episode in episodes:
+                print(episode)
+
+    def resolve_episodes(self):
+        """Looks up every episode on AniList and Reddit so that later runs hit the cache"""
+        episodes = self.qbittorrent.get_episodes()
+        self.prefetcher.submit_all(episodes)
+        discussions = self.prefetcher.results(episodes)
+        resolved = sum(1 for episode in episodes if episode.anilist_entry)
+        print(
+            f"Resolved {resolved} of {len(episodes)} episodes on AniList "
+            f"and found {len(list(filter(None, discussions)))} Reddit discussions"
+        )
+
+    def mark_watched(self, names: List[str], delete=False) -> bool:
+        """Returns True if the progress of every named episode was updated"""
+        if self.anilist.should_auth():
+            print("AniList requires your authorization. Run aniflow to authorize it first.")
+            return False
+
+        episodes, missing = self.find_episodes(names)
+        asyncio.run(self.anilist.update_episodes_with_anilist_data(episodes))
+        watched = []
+        for episode in episodes:
+            if episode.anilist_entry:
+                self.anilist.update_entry(episode)
+                watched.append(episode)
+            else:
+                print(f"Could not find {episode} on AniList")
+        self.anilist.wait_for_flush()
+        if self.anilist.encountered_auth_error:
+            print("Failed to update progress on AniList")
+            return False
+
+        queued = self.anilist.progress_queue.items()
+        updated = []
+        for episode in watched:
+            media_id = episode.anilist_entry.id
+            if media_id in queued or media_id in self.anilist.rejected_media_ids:
+                print(f"Failed to update progress on AniList for {episode}")
+            else:
+                print(f"Updated progress for {episode}")
+                updated.append(episode)
+        if delete:
+            self.qbittorrent.delete_many(updated)
+        return not missing and len(updated) == len(episodes)
+
+    def find_episodes(self, names: List[str]) -> tuple[List[Episode], List[str]]:
+        """Returns the episodes matching a path, file name or name as listed, and the names without a match"""
+        episodes = self.qbittorrent.get_episodes()
+        found = []
+        missing = []
+        for name in names:
+            matches = [
+                episode
+                for episode in episodes
+                if name
+                in (episode.path, episode.file_name, Path(episode.path).name, str(episode))
+            ]
+            if not matches:
+                print(f"Could not find episode {name}")
+                missing.append(name)
+            found.extend(episode for episode in matches if episode not in found)
+        return found, missing
+
+    def get_episode_details(self, episode: Episode) -> dict:
+        entry = episode.anilist_entry
+        return {
+            "name": str(episode),
+            "path": episode.path,
+            "torrent_hash": episode.torrent_hash,
+            "anime_title": episode.anime_title,
+            "season": episode.season,
+            "episode_number": episode.episode_number,
+            "absolute_episode_number": episode.absolute_episode_number,
+            "anilist": (
+                {
+                    "id": entry.id,
+                    "titles": entry.titles,
+                    "url": entry.url,
+                    "episode_count": entry.episode_count,
+                    "progress": self.anilist.get_progress(episode),
+                }
+                if entry
+                else None
+            ),
+        }
+
+    def get_progress(self, episode: Episode):
+        # Progress is only a hint, so don't wait for AniList to start up
+        anilist = self._anilist.get_if_ready()
+        return anilist.get_progress(episode) if anilist else None
+
+    def is_watched(self, episode: Episode) -> bool:
+        if not episode.episode_number:
+            return False
+        progress = self.get_progress(episode)
+        return progress is not None and float(episode.episode_number) <= progress
+
+    def is_resolved(self, episode: Episode) -> bool:
+        return episode.anilist_entry is not None
+
+    async def prepare_prefetch(self, episodes: List[Episode]):
+        # Lets the prefetches of newly listed episodes share batched searches
+        anilist = await asyncio.to_thread(self._anilist.get)
+        anilist.start_searches(episodes, background=True)
+
+    async def prefetch_data(self, episode: Episode, background=False):
+        # Services may still be starting up, so wait for them off the event loop
+        anilist = await asyncio.to_thread(self._anilist.get)
+        await anilist.update_episode_with_anilist_data(episode, background=background)
+        reddit = await asyncio.to_thread(self._reddit.get)
+        return await asyncio.to_thread(reddit.find_discussion, episode)
+
+
+def add_global_options(parser: argparse.ArgumentParser, suppress_defaults=False):
+    """Adds the options accepted before or after a command.
+
+    A command's parser suppresses the defaults so that it doesn't overwrite
+    options given before the command.
+    """
+    default = argparse.SUPPRESS if suppress_defaults else None
+    parser.add_argument(
+        "--clear-cache",
+        action="store_true",
+        default=default,
+        help="invalidate all cached metadata and exit",
+    )
+    parser.add_argument(
+        "--trace",
+        action="store_true",
+        default=default,
+        help="record timings and write them as a Chrome trace on exit",
+    )
+    parser.add_argument(
+        "--trace-file",
+        type=Path,
+        metavar="PATH",
+        default=default,
+        help='where --trace writes the trace (default: "aniflow-trace.json" in the project root)',
+    )
 
 
 if __name__ == "__main__":
-    AniFlow().start()
+    parser = argparse.ArgumentParser(prog="aniflow")
+    add_global_options(parser)
+    subparsers = parser.add_subparsers(
+        dest="command", title="commands", description="run without prompting"
+    )
+    list_parser = subparsers.add_parser(
+        "list", help="print the episodes ready to watch"
+    )
+    add_global_options(list_parser, suppress_defaults=True)
+    list_parser.add_argument(
+        "--json",
+        action="store_true",
+        help="print the episodes with their AniList entries as JSON",
+    )
+    resolve_parser = subparsers.add_parser(
+        "resolve", help="look up every episode on AniList and Reddit ahead of time"
+    )
+    add_global_options(resolve_parser, suppress_defaults=True)
+    mark_watched_parser = subparsers.add_parser(
+        "mark-watched", help="update the progress on AniList for episodes"
+    )
+    add_global_options(mark_watched_parser, suppress_defaults=True)
+    mark_watched_parser.add_argument(
+        "episodes",
+        nargs="+",
+        metavar="episode",
+        help="path, file name or name of the episode as listed",
+    )
+    mark_watched_parser.add_argument(
+        "--delete", action="store_true", help="delete the episodes afterwards"
+    )
+    args = parser.parse_args()
+
+    if args.trace:
+        tracing.enable(args.trace_file or get_root_dir() / "aniflow-trace.json")
+
+    if args.clear_cache:
+        Cache.clear_all()
+        print("Cleared cache")
+        exit()
+
+    match args.command:
+        case "list":
+            AniFlow().list_episodes(as_json=args.json)
+        case "resolve":
+            AniFlow().resolve_episodes()
+        case "mark-watched":
+            if not AniFlow().mark_watched(args.episodes, delete=args.delete):
+                exit(1)
+        case _:
+            AniFlow().start()
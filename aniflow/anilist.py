@@ -1,15 +1,25 @@
+import asyncio
+import hashlib
 import logging
-import math
+import re
 import string
+import time
 import webbrowser
+from datetime import timedelta
 from difflib import SequenceMatcher
 from os import getenv
+from threading import Lock, Thread, current_thread
 from typing import List
 
-import requests
 import tmdb
-from common import AniListEntry, Episode, nested_get
+from cache import Cache
+from common import AniListEntry, Episode, Franchise, nested_get
 from dotenv import find_dotenv, set_key, unset_key
+from http_session import get_session
+from progress_queue import ProgressQueue
+from rate_limiter import RateLimiter
+from requests import RequestException
+from title_index import TitleIndex
 
 
 class AniList:
@@ -18,11 +28,63 @@ class AniList:
     KEY_ANILIST_CLIENT_ID = "ANILIST_CLIENT_ID"
     KEY_ANILIST_TOKEN = "ANILIST_TOKEN"
     MIN_TITLE_SIMILARITY_RATIO = 0.9
+    # Stricter since an offline match isn't confirmed by an AniList search
+    MIN_OFFLINE_TITLE_SIMILARITY_RATIO = 0.95
+    # Used for season numbers, e.g. "Overlord II". "V" and "X" are left out
+    # since they are often part of the title itself.
+    ROMAN_NUMERALS = {"ii": 2, "iii": 3, "iv": 4, "vi": 6, "vii": 7, "viii": 8, "ix": 9}
+    MAX_RATE_LIMITED_ATTEMPTS = 3
+    PROGRESS_BATCH_SIZE = 20
+    MAX_PROGRESS_ATTEMPTS = 5
+    SEARCH_BATCH_SIZE = 10
+    ABSOLUTE_EPISODE_NUMBER_THRESHOLD = 100
     ACCEPTABLE_CHARS = set(string.printable)
 
     def __init__(self) -> None:
         self._token = getenv("ANILIST_TOKEN")
+        self.session = get_session()
+        # Adjusted to the limit AniList reports in each response's headers
+        self.rate_limiter = RateLimiter(
+            requests_per_minute=int(getenv("ANILIST_REQUESTS_PER_MINUTE", 90))
+        )
         self.tmdb = tmdb.TMDB()
+        self.resolution_cache = Cache(
+            "anilist-resolution",
+            ttl=timedelta(days=int(getenv("ANILIST_CACHE_TTL_DAYS", 7))),
+        )
+        # Franchise tables keyed by the AniList ids TMDB maps to
+        self.franchise_cache = Cache(
+            "anilist-franchises",
+            ttl=timedelta(days=int(getenv("ANILIST_CACHE_TTL_DAYS", 7))),
+        )
+        # How often each show needed the TMDB fallback to resolve
+        self.resolution_history = Cache("anilist-resolution-history")
+        # Seeds the offline title index with every entry resolved so far
+        self.known_entries = Cache("anilist-entries")
+        self.title_index = TitleIndex()
+        for entry in self.known_entries.items().values():
+            self.title_index.add(AniListEntry(entry))
+
+        # The user's CURRENT, PLANNING and REPEATING entries and their progress
+        self.watching_index = TitleIndex()
+        self.watching_progress: dict[int, int] = {}
+        self.viewer_ids = Cache("anilist-viewer")
+        Thread(target=self._refresh_watching_list_periodically, daemon=True).start()
+
+        # Batched searches, each show's position in them and whether they were
+        # sent in the background by cache key, only touched from the event loop
+        self._searches: dict[str, tuple[asyncio.Task, int, bool]] = {}
+
+        self.progress_queue = ProgressQueue()
+        # Media whose last progress update was rejected or given up on
+        self.rejected_media_ids: set[int] = set()
+        self.encountered_auth_error = False
+        self._flush_lock = Lock()
+        self._flush_thread = None
+        self._flush_requested = False
+        # Replay updates that weren't sent before the last exit
+        if self._token and self.progress_queue.items():
+            self.flush_progress_in_background()
 
     def should_auth(self) -> bool:
         return not self._token
@@ -34,114 +96,587 @@ class AniList:
 
     def set_access_token(self, token):
         self._token = token
+        self.encountered_auth_error = False
         set_key(find_dotenv(), self.KEY_ANILIST_TOKEN, self._token)
+        self.flush_progress_in_background()
+        Thread(target=self.refresh_watching_list, daemon=True).start()
 
     def clear_access_token(self):
         self._token = None
         unset_key(find_dotenv(), self.KEY_ANILIST_TOKEN)
 
-    def update_entry(self, episode: Episode) -> bool:
-        """Returns True if there is an Auth error"""
+    def update_entry(self, episode: Episode):
+        """Queues the episode's progress and sends it in the background"""
+        status = "COMPLETED" if episode.is_last_episode() else "CURRENT"
+        progress = int(episode.episode_number) if episode.episode_number else 1
+        self.progress_queue.put(episode.anilist_entry.id, status, progress)
+        if progress > self.watching_progress.get(episode.anilist_entry.id, 0):
+            self.watching_progress[episode.anilist_entry.id] = progress
+        self.flush_progress_in_background()
+
+    def refresh_watching_list(self):
+        """Fetches the entries the user is watching or planning to watch in one request"""
+        viewer_id = self._get_viewer_id()
+        if not viewer_id:
+            return
 
         query = """
-        mutation ($mediaId: Int, $status: MediaListStatus, $progress: Int) {
-            SaveMediaListEntry (mediaId: $mediaId, status: $status, progress: $progress) {
-                score
+        query ($userId: Int) {
+            MediaListCollection(
+                userId: $userId, type: ANIME, status_in: [CURRENT, PLANNING, REPEATING]
+            ) {
+                lists {
+                    entries {
+                        progress
+                        media {
+                            id
+                            title {
+                                romaji
+                                english
+                            }
+                            synonyms
+                            episodes
+                            siteUrl
+                        }
+                    }
+                }
             }
         }
         """
-        status = "COMPLETED" if episode.is_last_episode() else "CURRENT"
-        progress = int(episode.episode_number) if episode.episode_number else 1
-        variables = {
-            "mediaId": episode.anilist_entry.id,
-            "status": status,
-            "progress": progress,
-        }
         headers = {
             "Authorization": f"Bearer {self._token}",
         }
+        response = self._post(
+            query, {"userId": viewer_id}, headers=headers, background=True
+        )
+        if response.status_code != 200:
+            logging.info(f"Failed to fetch AniList list: {response.status_code}")
+            return
 
-        response = requests.post(
-            self.GRAPHQL_URL,
-            json={"query": query, "variables": variables},
-            headers=headers,
+        watching_index = TitleIndex()
+        watching_progress = {}
+        lists = nested_get(response.json(), ["data", "MediaListCollection", "lists"])
+        for media_list in lists or []:
+            for list_entry in media_list.get("entries") or []:
+                anime = list_entry.get("media")
+                anime["titles"], anime["synonyms"] = self._get_titles(anime)
+                entry = AniListEntry(anime)
+                watching_index.add(entry)
+                watching_progress[entry.id] = list_entry.get("progress") or 0
+        self.watching_index, self.watching_progress = watching_index, watching_progress
+
+    def get_progress(self, episode: Episode) -> int | None:
+        """Returns the progress on the user's list for the episode's anime, if known"""
+        entry = episode.anilist_entry or self._match_anime_offline(
+            episode, self.watching_index
         )
-        match response.status_code:
-            case 200:
-                pass
-            case 400:
-                invalid_token = any(
-                    error.get("message") == "Invalid token"
-                    for error in response.json().get("errors")
+        return self.watching_progress.get(entry.id) if entry else None
+
+    def flush_progress_in_background(self):
+        with self._flush_lock:
+            self._flush_requested = True
+            if not self._flush_thread:
+                self._flush_thread = Thread(
+                    target=self._flush_progress_loop, daemon=True
                 )
-                if invalid_token:
-                    self.clear_access_token()
-                return invalid_token
-            case _:
-                return False
+                self._flush_thread.start()
+
+    def wait_for_flush(self):
+        """Waits until the progress updates queued so far have been sent or given up on"""
+        with self._flush_lock:
+            flush_thread = self._flush_thread
+        if flush_thread:
+            flush_thread.join()
+
+    def flush_progress(self) -> bool:
+        """Sends queued progress updates in batches. Returns True if there is an Auth error.
+
+        Updates that fail are kept queued and retried on the next flush, up to
+        MAX_PROGRESS_ATTEMPTS times, while updates AniList rejects are dropped.
+        """
+        if not self._token:
+            return True
+
+        updates = list(self.progress_queue.items().items())
+        for start in range(0, len(updates), self.PROGRESS_BATCH_SIZE):
+            batch = dict(updates[start : start + self.PROGRESS_BATCH_SIZE])
+            try:
+                if self._send_progress_batch(batch):
+                    return True
+            except Exception:
+                logging.exception("Failed to send AniList progress updates")
+                self._record_progress_failure(batch)
 
         return False
 
-    def update_episode_with_anilist_data(self, episode: Episode):
-        query = """
-        query ($search: String) {
-            anime: Page(perPage: 2) {
-                results: media(type: ANIME, search: $search) {
-                    id
-                    title {
-                        romaji
-                        english
-                    }
-                    synonyms
-                    episodes
-                    siteUrl
-                    relations {
-                        edges {
-                            relationType
-                        }
-                        nodes {
-                            id
-                        }
-                    }
-                }
-            }
+    def _send_progress_batch(self, batch: dict[int, dict]) -> bool:
+        """Sends the updates in one request. Returns True if there is an Auth error."""
+        parameters = []
+        mutations = []
+        variables = {}
+        for i, (media_id, update) in enumerate(batch.items()):
+            parameters.append(
+                f"$mediaId{i}: Int, $status{i}: MediaListStatus, $progress{i}: Int"
+            )
+            mutations.append(
+                f"entry{i}: SaveMediaListEntry "
+                f"(mediaId: $mediaId{i}, status: $status{i}, progress: $progress{i}) "
+                "{ score }"
+            )
+            variables[f"mediaId{i}"] = media_id
+            variables[f"status{i}"] = update["status"]
+            variables[f"progress{i}"] = update["progress"]
+        query = f"mutation ({', '.join(parameters)}) {{ {' '.join(mutations)} }}"
+        headers = {
+            "Authorization": f"Bearer {self._token}",
         }
+
+        try:
+            response = self._post(query, variables, headers=headers)
+            body = response.json() if response.status_code in (200, 400) else None
+        except (RequestException, ValueError) as e:
+            logging.info(f"Failed to send AniList progress updates: {e}")
+            self._record_progress_failure(batch)
+            return False
+        if not isinstance(body, dict):
+            logging.info(
+                f"Failed to send AniList progress updates: {response.status_code}"
+            )
+            self._record_progress_failure(batch)
+            return False
+
+        errors = body.get("errors") or []
+        if any(error.get("message") == "Invalid token" for error in errors):
+            self.clear_access_token()
+            return True
+
+        # Each alias is saved on its own, so errors only reject their own update
+        rejected_aliases = {error["path"][0] for error in errors if error.get("path")}
+        saved = body.get("data") or {}
+        sent, rejected, failed = {}, {}, {}
+        for i, (media_id, update) in enumerate(batch.items()):
+            if f"entry{i}" in rejected_aliases:
+                rejected[media_id] = update
+            elif saved.get(f"entry{i}"):
+                sent[media_id] = update
+            else:
+                failed[media_id] = update
+        self.progress_queue.remove(sent)
+        self.rejected_media_ids.difference_update(sent)
+        if rejected:
+            # Retrying won't help a rejected update
+            logging.info(f"AniList rejected progress updates for {list(rejected)}")
+            self.progress_queue.remove(rejected)
+            self.rejected_media_ids.update(rejected)
+        if failed:
+            self._record_progress_failure(failed)
+
+        return False
+
+    def _record_progress_failure(self, updates: dict[int, dict]):
+        """Keeps the updates queued until they have failed MAX_PROGRESS_ATTEMPTS times"""
+        given_up = self.progress_queue.record_failure(updates, self.MAX_PROGRESS_ATTEMPTS)
+        if given_up:
+            logging.info(f"Gave up on AniList progress updates for {given_up}")
+            self.rejected_media_ids.update(given_up)
+
+    def _flush_progress_loop(self):
+        try:
+            while True:
+                with self._flush_lock:
+                    if not self._flush_requested:
+                        self._flush_thread = None
+                        return
+                    self._flush_requested = False
+
+                try:
+                    if self.flush_progress():
+                        self.encountered_auth_error = True
+                except Exception:
+                    # The updates stay queued for the next flush
+                    logging.exception("Failed to flush AniList progress updates")
+        finally:
+            # Lets the next update start a new flush if this one died
+            with self._flush_lock:
+                if self._flush_thread is current_thread():
+                    self._flush_thread = None
+
+    def start_searches(self, episodes: List[Episode], background=False):
+        """Searches AniList for every distinct show of the episodes that can't be resolved offline.
+
+        Up to SEARCH_BATCH_SIZE titles are sent per request and episodes resolved
+        afterwards reuse the results. Must be called from a running event loop.
         """
-        search_title = episode.fmt_str(delimiter=" ", include_episode_number=False)
-        variables = {"search": search_title}
+        self._searches = {
+            cache_key: search
+            for cache_key, search in self._searches.items()
+            if not search[0].done()
+        }
+        search_titles = {}
+        for episode in episodes:
+            cache_key = self._get_cache_key(episode)
+            if (
+                cache_key in self._searches
+                or cache_key in search_titles
+                or self.resolution_cache.get(cache_key)
+                or self._match_anime_offline(episode, self.watching_index)
+                or self._match_anime_offline(episode, self.title_index)
+            ):
+                continue
+            search_titles[cache_key] = self._get_search_title(episode)
+
+        cache_keys = list(search_titles)
+        for batch_start in range(0, len(cache_keys), self.SEARCH_BATCH_SIZE):
+            batch = cache_keys[batch_start : batch_start + self.SEARCH_BATCH_SIZE]
+            search = asyncio.create_task(
+                asyncio.to_thread(
+                    self._search_anime_batch,
+                    [search_titles[cache_key] for cache_key in batch],
+                    background,
+                )
+            )
+            for i, cache_key in enumerate(batch):
+                self._searches[cache_key] = (search, i, background)
 
-        response = requests.post(
-            self.GRAPHQL_URL, json={"query": query, "variables": variables}
+    async def update_episodes_with_anilist_data(
+        self, episodes: List[Episode], background=False
+    ):
+        """Resolves the episodes with one AniList search per distinct show.
+
+        An episode that fails to resolve is logged and left without an entry.
+        """
+        self.start_searches(episodes, background=background)
+        results = await asyncio.gather(
+            *(
+                self.update_episode_with_anilist_data(episode, background=background)
+                for episode in episodes
+            ),
+            return_exceptions=True,
         )
-        if response.status_code != 200:
-            print(f"Bad status code: {response.status_code} {response.reason}")
+        for episode, result in zip(episodes, results):
+            if isinstance(result, Exception):
+                logging.error(f"Failed to resolve {episode} on AniList", exc_info=result)
+
+    async def update_episode_with_anilist_data(
+        self, episode: Episode, background=False
+    ):
+        cache_key = self._get_cache_key(episode)
+        if self._update_episode_from_cache(episode, self.resolution_cache.get(cache_key)):
+            logging.debug("Found AniList entry in cache")
             return
 
-        results = nested_get(response.json(), ["data", "anime", "results"])
+        entry = self._match_anime_offline(
+            episode, self.watching_index
+        ) or self._match_anime_offline(episode, self.title_index)
+        if entry:
+            logging.debug("Found AniList entry in offline title index")
+            episode.anilist_entry = entry
+            self.resolution_cache.set(cache_key, {"entry": entry.to_dict()})
+            return
 
-        anime = self._match_anime(episode, results)
-        if not anime:
-            logging.debug("Failed to confidently find anime on AniList")
-            entry_ids, absolute_episode_number = self.tmdb.search(episode)
-            if not entry_ids:
-                logging.debug("Could not find anime on TMDB")
+        # Search TMDB alongside AniList for shows that usually need the fallback
+        tmdb_search = None
+        if self._should_search_tmdb_speculatively(episode):
+            tmdb_search = asyncio.create_task(asyncio.to_thread(self.tmdb.search, episode))
+
+        try:
+            search = self._searches.get(cache_key)
+            # A batch still waiting behind the background reserve would hold an
+            # urgent lookup back, so the lookup searches on its own instead
+            if search and (background or not search[2] or search[0].done()):
+                batch, i, _ = search
+                # Shielded so that a cancelled prefetch doesn't cancel the whole batch
+                batch_results = await asyncio.shield(batch)
+                results = None if batch_results is None else batch_results[i]
+            else:
+                results = await asyncio.to_thread(self._search_anime, episode, background)
+            if results is None:
                 return
-            graph = {}
-            head_node_id = self._build_graph(entry_ids, graph)
-            entry_id, relative_episode_number = self._find_entry_based_on_abs_ep_number(
-                absolute_episode_number, graph, head_node_id
-            )
-            if absolute_episode_number != relative_episode_number:
-                episode.absolute_episode_number = str(absolute_episode_number)
-                episode.episode_number = str(relative_episode_number)
-            episode.anilist_entry = graph.get(entry_id)
-            if episode.anilist_entry:
-                logging.debug("Found AniList entry after falling back to TMDB")
+
+            anime = self._match_anime(episode, results)
+            if not anime:
+                logging.debug("Failed to confidently find anime on AniList")
+                tmdb_result = await (
+                    tmdb_search or asyncio.to_thread(self.tmdb.search, episode)
+                )
+                await asyncio.to_thread(
+                    self._update_episode_with_tmdb_data,
+                    episode,
+                    cache_key,
+                    tmdb_result,
+                    background,
+                )
+                self._record_resolution(episode, used_tmdb=True)
+                return
+        finally:
+            if tmdb_search:
+                # Discard the speculative search if AniList matched first
+                tmdb_search.cancel()
+                if tmdb_search.done() and not tmdb_search.cancelled():
+                    tmdb_search.exception()
+
+        episode.anilist_entry = AniListEntry(anime)
+        self.resolution_cache.set(cache_key, {"entry": episode.anilist_entry.to_dict()})
+        self._add_known_entry(episode.anilist_entry)
+        self._record_resolution(episode, used_tmdb=False)
+
+    def _match_anime_offline(
+        self, episode: Episode, title_index: TitleIndex
+    ) -> AniListEntry | None:
+        """Returns the entry from the title index if it is a confident match.
+
+        Titles of different seasons are often nearly identical, so the numbers
+        in the titles have to agree as well.
+        """
+        title = episode.fmt_str(delimiter=" ", include_episode_number=False)
+        match = title_index.search(title)
+        if not match:
+            return None
+
+        entry, score, matched_title = match
+        if score < self.MIN_OFFLINE_TITLE_SIMILARITY_RATIO:
+            return None
+        if self._get_numbers(title) != self._get_numbers(matched_title):
+            return None
+        if (
+            episode.episode_number
+            and entry.episode_count
+            and float(episode.episode_number) > entry.episode_count
+        ):
+            return None
+        # Copied so that the episode doesn't share a mutable entry with the index
+        return AniListEntry(entry.to_dict())
+
+    def _get_numbers(self, title: str) -> List[int]:
+        """Returns the numbers in the title, such as its season"""
+        numbers = []
+        for word in re.findall(r"[^\W_]+", title.lower()):
+            if word in self.ROMAN_NUMERALS:
+                numbers.append(self.ROMAN_NUMERALS[word])
             else:
-                logging.debug("Could not find any AniList entry falling back to TMDB")
+                numbers.extend(int(digits) for digits in re.findall(r"\d+", word))
+        return numbers
+
+    def _add_known_entry(self, entry: AniListEntry):
+        self.known_entries.set(str(entry.id), entry.to_dict())
+        self.title_index.add(entry)
+
+    def _get_viewer_id(self) -> int | None:
+        if not self._token:
+            return None
+
+        # Keyed by a hash of the token so a new token looks the user up again
+        token_key = hashlib.sha256(self._token.encode()).hexdigest()
+        viewer_id = self.viewer_ids.get(token_key)
+        if viewer_id:
+            return viewer_id
+
+        headers = {
+            "Authorization": f"Bearer {self._token}",
+        }
+        response = self._post("query { Viewer { id } }", {}, headers=headers)
+        if response.status_code != 200:
+            return None
+        viewer_id = nested_get(response.json(), ["data", "Viewer", "id"])
+        if not viewer_id:
+            return None
+        self.viewer_ids.set(token_key, viewer_id)
+        return viewer_id
+
+    def _refresh_watching_list_periodically(self):
+        interval = float(getenv("ANILIST_LIST_REFRESH_MINUTES", 15)) * 60
+        while True:
+            try:
+                self.refresh_watching_list()
+            except Exception:
+                logging.exception("Failed to refresh AniList list")
+            time.sleep(interval)
+
+    def _should_search_tmdb_speculatively(self, episode: Episode) -> bool:
+        match getenv("ANILIST_SPECULATIVE_TMDB", "auto").lower():
+            case "always":
+                return True
+            case "never":
+                return False
+
+        history = self.resolution_history.get(self._get_show_key(episode))
+        if history:
+            return history["tmdb"] > history["anilist"]
+        # Absolute numbering usually means AniList won't match the title alone
+        return bool(
+            episode.episode_number
+            and float(episode.episode_number) > self.ABSOLUTE_EPISODE_NUMBER_THRESHOLD
+        )
+
+    def _record_resolution(self, episode: Episode, used_tmdb: bool):
+        show_key = self._get_show_key(episode)
+        history = self.resolution_history.get(show_key) or {"anilist": 0, "tmdb": 0}
+        history["tmdb" if used_tmdb else "anilist"] += 1
+        self.resolution_history.set(show_key, history)
+
+    def _get_show_key(self, episode: Episode) -> str:
+        return self._prepare_string_for_comparison(episode.anime_title or "")
+
+    def _search_anime(self, episode: Episode, background=False) -> List[dict]:
+        """Returns None if the search failed"""
+        batch_results = self._search_anime_batch(
+            [self._get_search_title(episode)], background=background
+        )
+        return None if batch_results is None else batch_results[0]
+
+    def _search_anime_batch(
+        self, search_titles: List[str], background=False
+    ) -> List[List[dict]]:
+        """Searches every title in one request as aliased fields. Returns None if the search failed"""
+        parameters = ", ".join(f"$search{i}: String" for i in range(len(search_titles)))
+        fields = "\n".join(
+            f"""
+            search{i}: Page(perPage: 2) {{
+                results: media(type: ANIME, search: $search{i}) {{
+                    ...media
+                }}
+            }}"""
+            for i in range(len(search_titles))
+        )
+        query = f"""
+        query ({parameters}) {{
+            {fields}
+        }}
+
+        fragment media on Media {{
+            id
+            title {{
+                romaji
+                english
+            }}
+            synonyms
+            episodes
+            siteUrl
+            relations {{
+                edges {{
+                    relationType
+                }}
+                nodes {{
+                    id
+                }}
+            }}
+        }}
+        """
+        variables = {f"search{i}": title for i, title in enumerate(search_titles)}
+
+        response = self._post(query, variables, background=background)
+        if response.status_code != 200:
+            print(f"Bad status code: {response.status_code} {response.reason}")
+            return None
+
+        data = response.json()
+        return [
+            nested_get(data, ["data", f"search{i}", "results"]) or []
+            for i in range(len(search_titles))
+        ]
+
+    def _get_search_title(self, episode: Episode) -> str:
+        return episode.fmt_str(delimiter=" ", include_episode_number=False)
+
+    def _update_episode_with_tmdb_data(
+        self, episode: Episode, cache_key: str, tmdb_result, background=False
+    ):
+        entry_ids, absolute_episode_number = tmdb_result
+        if not entry_ids:
+            logging.debug("Could not find anime on TMDB")
             return
+        franchise = self._get_franchise(entry_ids, background=background)
+        episode_offset = absolute_episode_number - int(episode.episode_number)
+        if self._update_episode_from_franchise(
+            episode, franchise, absolute_episode_number
+        ):
+            logging.debug("Found AniList entry after falling back to TMDB")
+            self._add_known_entry(episode.anilist_entry)
+            self.resolution_cache.set(
+                cache_key,
+                {
+                    "franchise_table": franchise.to_dict(),
+                    "episode_offset": episode_offset,
+                },
+            )
+        else:
+            logging.debug("Could not find any AniList entry falling back to TMDB")
+
+    def _get_franchise(self, ids: List[int], background=False) -> Franchise:
+        """Returns the franchise of the ids, building and storing its table if needed"""
+        franchise_key = ",".join(map(str, sorted(ids)))
+        cached = self.franchise_cache.get(franchise_key)
+        if cached:
+            return Franchise.from_dict(cached)
+
+        graph = {}
+        head_node_id = self._build_graph(ids, graph, background=background)
+        franchise = Franchise.from_graph(graph, head_node_id)
+        if franchise.entries:
+            self.franchise_cache.set(franchise_key, franchise.to_dict())
+        return franchise
+
+    def _update_episode_from_franchise(
+        self, episode: Episode, franchise: Franchise, absolute_episode_number: int
+    ) -> bool:
+        """Returns True if the absolute episode number is part of the franchise"""
+        location = franchise.locate(absolute_episode_number)
+        if not location:
+            return False
+        entry, relative_episode_number = location
+        if absolute_episode_number != relative_episode_number:
+            episode.absolute_episode_number = str(absolute_episode_number)
+            episode.episode_number = str(relative_episode_number)
+        episode.anilist_entry = entry
+        return True
+
+    def _post(self, query: str, variables: dict, headers=None, background=False):
+        """Sends a GraphQL request within the rate limit, retrying rate limited requests"""
+        for _ in range(self.MAX_RATE_LIMITED_ATTEMPTS):
+            self.rate_limiter.acquire(background)
+            response = self.session.post(
+                self.GRAPHQL_URL,
+                json={"query": query, "variables": variables},
+                headers=headers,
+            )
+            self.rate_limiter.update(response.headers)
+            if response.status_code != 429:
+                break
+            logging.debug("Rate limited by AniList, retrying")
+        return response
+
+    def _get_cache_key(self, episode: Episode) -> str:
+        return self._prepare_string_for_comparison(
+            episode.fmt_str(delimiter=" ", include_episode_number=False)
+        )
 
-        episode.anilist_entry = AniListEntry(anime)
+    def _update_episode_from_cache(self, episode: Episode, cached: dict) -> bool:
+        """Returns True if the cached resolution applies to the episode"""
+        if not cached:
+            return False
+
+        if "entry" in cached:
+            entry = AniListEntry(cached["entry"])
+            if (
+                episode.episode_number
+                and entry.episode_count
+                and float(episode.episode_number) > entry.episode_count
+            ):
+                return False
+            episode.anilist_entry = entry
+            return True
+
+        if (
+            "franchise_table" not in cached
+            or not episode.episode_number
+            or not episode.episode_number.isdigit()
+        ):
+            return False
+        return self._update_episode_from_franchise(
+            episode,
+            Franchise.from_dict(cached["franchise_table"]),
+            int(episode.episode_number) + cached["episode_offset"],
+        )
 
     def _is_valid_title(self, title) -> bool:
         """Returns True if all characters in the title argument are acceptable"""
@@ -183,88 +718,79 @@ class AniList:
                 anime["synonyms"] = synonyms
                 return anime
 
-    def _build_graph(self, ids: List[int], graph):
+    def _build_graph(self, ids: List[int], graph, background=False):
+        """Fetches every id in a single request and links prequels to sequels locally"""
         query = """
-        query ($id: Int) {
-            Media(type: ANIME, id: $id) {
-                id
-                title {
-                    romaji
-                    english
+        query ($ids: [Int], $page: Int) {
+            Page(page: $page, perPage: 50) {
+                pageInfo {
+                    hasNextPage
                 }
-                synonyms
-                episodes
-                siteUrl
-                relations {
-                    edges {
-                        relationType
+                media(type: ANIME, id_in: $ids) {
+                    id
+                    title {
+                        romaji
+                        english
                     }
-                    nodes {
-                        id
+                    synonyms
+                    episodes
+                    siteUrl
+                    relations {
+                        edges {
+                            relationType
+                        }
+                        nodes {
+                            id
+                        }
                     }
                 }
             }
         }
         """
-        head_node_id = None
-        for id in ids:
-            if id in graph:
-                continue
-
-            variables = {"id": id}
-            response = requests.post(
-                self.GRAPHQL_URL, json={"query": query, "variables": variables}
-            )
+        missing_ids = [id for id in ids if id not in graph]
+        relations = {}
+        page = 1
+        while missing_ids and page:
+            variables = {"ids": missing_ids, "page": page}
+            response = self._post(query, variables, background=background)
             if response.status_code != 200:
                 print("ERROR", response.status_code)
-                continue
-
-            anime = nested_get(response.json(), ["data", "Media"])
-            anime["titles"], anime["synonyms"] = self._get_titles(anime)
-            edges = nested_get(anime, ["relations", "edges"])
-            nodes = nested_get(anime, ["relations", "nodes"])
-            if not edges and not nodes:
-                continue
-
-            curr_node = AniListEntry(anime)
-            graph[id] = curr_node
-
-            for edge, node in zip(edges, nodes):
-                relation_type = edge.get("relationType")
-                if relation_type not in {"PREQUEL", "SEQUEL"}:
-                    continue
+                break
+
+            data = nested_get(response.json(), ["data", "Page"]) or {}
+            for anime in data.get("media") or []:
+                anime["titles"], anime["synonyms"] = self._get_titles(anime)
+                graph[anime["id"]] = AniListEntry(anime)
+                relations[anime["id"]] = zip(
+                    nested_get(anime, ["relations", "edges"]) or [],
+                    nested_get(anime, ["relations", "nodes"]) or [],
+                )
+            page = page + 1 if nested_get(data, ["pageInfo", "hasNextPage"]) else None
 
-                related_node_id = node.get("id")
-                if related_node_id not in ids:
+        for id, edges in relations.items():
+            curr_node = graph[id]
+            for edge, node in edges:
+                related_node = graph.get(node.get("id"))
+                if not related_node:
                     continue
 
-                head_node_id = head_node_id or self._build_graph(ids, graph)
-                related_node = graph[related_node_id]
-                match relation_type:
+                match edge.get("relationType"):
                     case "PREQUEL":
-                        curr_node.prequel = related_node_id
+                        curr_node.prequel = related_node.id
                         related_node.sequel = id
                     case "SEQUEL":
                         curr_node.sequel = related_node.id
                         related_node.prequel = id
 
-            if not curr_node.prequel:
-                head_node_id = id
-        return head_node_id
+        # Specials and side stories have no prequel either, so the head of the
+        # longest chain of sequels is taken as the main series
+        heads = [id for id in ids if id in graph and not graph[id].prequel]
+        return max(heads, key=lambda id: self._get_chain_length(graph, id), default=None)
 
-    def _find_entry_based_on_abs_ep_number(
-        self, absolute_episode_number, graph: dict[int, AniListEntry], head_id
-    ):
+    def _get_chain_length(self, graph: dict[int, AniListEntry], head_id: int) -> int:
+        seen = set()
         id = head_id
-        cumulative_episode_count = 0
-        while id:
-            node = graph[id]
-            start = cumulative_episode_count + 1
-            end = start + node.episode_count - 1 if node.episode_count else math.inf
-            if start <= absolute_episode_number <= end:
-                relative_episode_number = (
-                    absolute_episode_number - cumulative_episode_count
-                )
-                return id, relative_episode_number
-            id = node.sequel
-            cumulative_episode_count += node.episode_count
+        while id in graph and id not in seen:
+            seen.add(id)
+            id = graph[id].sequel
+        return len(seen)
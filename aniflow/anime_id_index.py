@@ -0,0 +1,66 @@
+import json
+import os
+from array import array
+from bisect import bisect_left, bisect_right
+from pathlib import Path
+from typing import List
+
+
+class AnimeIdIndex:
+    """Sorted themoviedb_id to anilist_id pairs built from the anime id database"""
+
+    TYPES = {"TV", "SPECIALS"}
+    INDEX_SUFFIX = ".index"
+    # Native unsigned int, which is at least 4 bytes on every supported platform
+    TYPECODE = "I"
+
+    def __init__(self, source_path: Path) -> None:
+        self.source_path = source_path
+        self.index_path = source_path.with_name(source_path.name + self.INDEX_SUFFIX)
+        self._ids = (array(self.TYPECODE), array(self.TYPECODE))
+        self.load()
+
+    def load(self):
+        """Reads the index, rebuilding it first if the source file has changed"""
+        if self._is_stale():
+            self.build()
+
+        tmdb_ids = array(self.TYPECODE)
+        anilist_ids = array(self.TYPECODE)
+        with open(self.index_path, "rb") as index:
+            count = array(self.TYPECODE)
+            count.fromfile(index, 1)
+            tmdb_ids.fromfile(index, count[0])
+            anilist_ids.fromfile(index, count[0])
+        # Swapped as a single tuple so lookups on other threads never mix versions
+        self._ids = (tmdb_ids, anilist_ids)
+
+    def build(self):
+        pairs = set()
+        with open(self.source_path, "r") as anime_id_db:
+            for entry in json.load(anime_id_db):
+                anilist_id = entry.get("anilist_id")
+                tmdb_id = entry.get("themoviedb_id")
+                type = entry.get("type")
+                if anilist_id and tmdb_id and type in self.TYPES:
+                    pairs.add((int(tmdb_id), int(anilist_id)))
+        pairs = sorted(pairs)
+
+        temp_path = self.index_path.with_name(self.index_path.name + ".tmp")
+        with open(temp_path, "wb") as index:
+            array(self.TYPECODE, [len(pairs)]).tofile(index)
+            array(self.TYPECODE, (tmdb_id for tmdb_id, _ in pairs)).tofile(index)
+            array(self.TYPECODE, (anilist_id for _, anilist_id in pairs)).tofile(index)
+        os.replace(temp_path, self.index_path)
+
+    def get(self, tmdb_id: int) -> List[int]:
+        tmdb_ids, anilist_ids = self._ids
+        start = bisect_left(tmdb_ids, tmdb_id)
+        end = bisect_right(tmdb_ids, tmdb_id, lo=start)
+        return anilist_ids[start:end].tolist()
+
+    def _is_stale(self) -> bool:
+        return (
+            not self.index_path.exists()
+            or self.index_path.stat().st_mtime < self.source_path.stat().st_mtime
+        )
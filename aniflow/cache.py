@@ -0,0 +1,143 @@
+import json
+import sqlite3
+import time
+from datetime import timedelta
+from threading import Lock
+
+from common import get_root_dir
+
+
+class Cache:
+    """Persistent key-value store backed by a SQLite file in the project root.
+
+    Durable entries, such as changes that still have to be sent, are kept in
+    their own table so that clearing the cache doesn't lose them.
+    """
+
+    FILE_NAME = "aniflow-cache.sqlite3"
+    TABLE = "cache"
+    DURABLE_TABLE = "durable"
+
+    _connection = None
+    _lock = Lock()
+
+    def __init__(self, namespace: str, ttl: timedelta = None, durable=False) -> None:
+        self.namespace = namespace
+        self.ttl = ttl
+        self._table = self.DURABLE_TABLE if durable else self.TABLE
+
+    def get(self, key: str):
+        with self._lock:
+            row = (
+                self._connect()
+                .execute(
+                    f"SELECT value, updated_at FROM {self._table} WHERE namespace = ? AND key = ?",
+                    (self.namespace, key),
+                )
+                .fetchone()
+            )
+        if not row:
+            return None
+
+        value, updated_at = row
+        if self._is_expired(updated_at):
+            self.invalidate(key)
+            return None
+        return json.loads(value)
+
+    def set(self, key: str, value) -> None:
+        with self._lock:
+            connection = self._connect()
+            connection.execute(
+                f"INSERT OR REPLACE INTO {self._table} (namespace, key, value, updated_at) VALUES (?, ?, ?, ?)",
+                (self.namespace, key, json.dumps(value), time.time()),
+            )
+            connection.commit()
+
+    def set_many(self, items: dict) -> None:
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            connection.executemany(
+                f"INSERT OR REPLACE INTO {self._table} (namespace, key, value, updated_at) VALUES (?, ?, ?, ?)",
+                (
+                    (self.namespace, key, json.dumps(value), now)
+                    for key, value in items.items()
+                ),
+            )
+            connection.commit()
+
+    def items(self) -> dict:
+        """Returns every unexpired entry in the namespace"""
+        with self._lock:
+            rows = (
+                self._connect()
+                .execute(
+                    f"SELECT key, value, updated_at FROM {self._table} WHERE namespace = ?",
+                    (self.namespace,),
+                )
+                .fetchall()
+            )
+        return {
+            key: json.loads(value)
+            for key, value, updated_at in rows
+            if not self._is_expired(updated_at)
+        }
+
+    def invalidate(self, key: str = None) -> None:
+        """Removes the entry for key, or every entry in the namespace if key is None"""
+        with self._lock:
+            connection = self._connect()
+            if key is None:
+                connection.execute(
+                    f"DELETE FROM {self._table} WHERE namespace = ?", (self.namespace,)
+                )
+            else:
+                connection.execute(
+                    f"DELETE FROM {self._table} WHERE namespace = ? AND key = ?",
+                    (self.namespace, key),
+                )
+            connection.commit()
+
+    def purge_expired(self) -> None:
+        """Removes every expired entry in the namespace, including ones never read again"""
+        if self.ttl is None:
+            return
+        with self._lock:
+            connection = self._connect()
+            connection.execute(
+                f"DELETE FROM {self._table} WHERE namespace = ? AND updated_at < ?",
+                (self.namespace, time.time() - self.ttl.total_seconds()),
+            )
+            connection.commit()
+
+    def _is_expired(self, updated_at: float) -> bool:
+        return self.ttl is not None and time.time() - updated_at > self.ttl.total_seconds()
+
+    @classmethod
+    def clear_all(cls) -> None:
+        """Removes every entry except durable ones"""
+        with cls._lock:
+            connection = cls._connect()
+            connection.execute(f"DELETE FROM {cls.TABLE}")
+            connection.commit()
+
+    @classmethod
+    def _connect(cls) -> sqlite3.Connection:
+        if not cls._connection:
+            cls._connection = sqlite3.connect(
+                get_root_dir() / cls.FILE_NAME, check_same_thread=False
+            )
+            for table in (cls.TABLE, cls.DURABLE_TABLE):
+                cls._connection.execute(
+                    f"""
+                    CREATE TABLE IF NOT EXISTS {table} (
+                        namespace TEXT NOT NULL,
+                        key TEXT NOT NULL,
+                        value TEXT NOT NULL,
+                        updated_at REAL NOT NULL,
+                        PRIMARY KEY (namespace, key)
+                    )
+                    """
+                )
+        return cls._connection
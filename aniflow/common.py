@@ -1,13 +1,59 @@
 from math import e
+from bisect import bisect_right
 from pathlib import Path
-from threading import Thread
+from threading import Lock, Thread
 
 import anitopy
+import tracing
 from anitopy.element import ElementCategory
 from annotated_types import T
 
+ANITOPY_OPTIONS = {
+    "parse_file_extension": False,
+    "parse_release_group": False,
+    "allowed_delimiters": " _&+,|",
+}
+ANITOPY_ELEMENTS = {
+    ElementCategory.ANIME_TITLE.value,
+    ElementCategory.EPISODE_NUMBER.value,
+    ElementCategory.ANIME_SEASON.value,
+    ElementCategory.RELEASE_VERSION.value,
+}
+
+# File names never change, so each one only has to be parsed once
+parsed_file_names: dict[str, dict] = {}
+
+
+def parse_file_name(file_name: str) -> dict:
+    details = parsed_file_names.get(file_name)
+    if details is None:
+        details = {
+            element: value
+            for element, value in anitopy.parse(
+                file_name, options=ANITOPY_OPTIONS
+            ).items()
+            if element in ANITOPY_ELEMENTS
+        }
+        parsed_file_names[file_name] = details
+    return details
+
 
 class Episode:
+
+    __slots__ = (
+        "index",
+        "file_name",
+        "path",
+        "torrent_hash",
+        "can_delete_torrent",
+        "anime_title",
+        "episode_number",
+        "absolute_episode_number",
+        "season",
+        "release_version",
+        "anilist_entry",
+    )
+
     def __init__(self, index, name, path, torrent_hash, can_delete_torrent):
         self.index = index
         self.file_name = name
@@ -15,12 +61,7 @@ class Episode:
         self.torrent_hash = torrent_hash
         self.can_delete_torrent = can_delete_torrent
 
-        anitopy_options = {
-            "parse_file_extension": False,
-            "parse_release_group": False,
-            "allowed_delimiters": " _&+,|",
-        }
-        details = anitopy.parse(self._get_file_name(), options=anitopy_options)
+        details = parse_file_name(self._get_file_name())
         self.anime_title = details.get(ElementCategory.ANIME_TITLE.value)
 
         episode_number = details.get(ElementCategory.EPISODE_NUMBER.value)
@@ -83,10 +124,24 @@ class Episode:
         return delimiter.join(self.fmt_str_tokens(**kwargs))
 
 
+def prune_parsed_file_names(episodes: list[Episode]):
+    """Forgets the parsed file names of episodes that are no longer listed"""
+    listed = {episode._get_file_name() for episode in episodes}
+    for file_name in [name for name in parsed_file_names if name not in listed]:
+        del parsed_file_names[file_name]
+
+
 class AniListEntry:
 
-    prequel = None
-    sequel = None
+    __slots__ = (
+        "id",
+        "titles",
+        "synonyms",
+        "url",
+        "episode_count",
+        "prequel",
+        "sequel",
+    )
 
     def __init__(self, anime: dict) -> None:
         self.id = anime.get("id")
@@ -94,6 +149,20 @@ class AniListEntry:
         self.synonyms = anime.get("synonyms", [])
         self.url = anime.get("siteUrl")
         self.episode_count = anime.get("episodes")
+        self.prequel = anime.get("prequel")
+        self.sequel = anime.get("sequel")
+
+    def to_dict(self) -> dict:
+        """Returns a dict that can be passed back into the constructor"""
+        return {
+            "id": self.id,
+            "titles": self.titles,
+            "synonyms": self.synonyms,
+            "siteUrl": self.url,
+            "episodes": self.episode_count,
+            "prequel": self.prequel,
+            "sequel": self.sequel,
+        }
 
     def __str__(self) -> str:
         return f"{self.id} {self.titles} {self.url} prequel={self.prequel} sequel={self.sequel} url={self.url}"
@@ -102,6 +171,60 @@ class AniListEntry:
         return self.__str__()
 
 
+class Franchise:
+    """Entries of a franchise in season order with a prefix sum of their episode counts"""
+
+    __slots__ = ("entries", "offsets")
+
+    def __init__(self, entries: list[AniListEntry], offsets: list[int] = None) -> None:
+        if offsets is None:
+            # An entry without an episode count is open-ended, so nothing after
+            # it can be located by absolute episode number
+            offsets = []
+            episodes_before = 0
+            for i, entry in enumerate(entries):
+                offsets.append(episodes_before)
+                if not entry.episode_count:
+                    entries = entries[: i + 1]
+                    break
+                episodes_before += entry.episode_count
+        self.entries = entries
+        self.offsets = offsets
+
+    @classmethod
+    def from_graph(cls, graph: dict[int, AniListEntry], head_id) -> "Franchise":
+        entries = []
+        id = head_id
+        while id in graph and graph[id] not in entries:
+            entries.append(graph[id])
+            id = graph[id].sequel
+        return cls(entries)
+
+    @classmethod
+    def from_dict(cls, franchise: dict) -> "Franchise":
+        return cls(
+            [AniListEntry(entry) for entry in franchise["entries"]],
+            franchise["offsets"],
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            "entries": [entry.to_dict() for entry in self.entries],
+            "offsets": self.offsets,
+        }
+
+    def locate(self, absolute_episode_number: int):
+        """Returns the entry and relative episode number, or None if out of range"""
+        i = bisect_right(self.offsets, absolute_episode_number - 1) - 1
+        if i < 0:
+            return None
+        entry = self.entries[i]
+        relative_episode_number = absolute_episode_number - self.offsets[i]
+        if entry.episode_count and relative_episode_number > entry.episode_count:
+            return None
+        return entry, relative_episode_number
+
+
 class ResultThread(Thread):
     def run(self):
         try:
@@ -113,6 +236,53 @@ class ResultThread(Thread):
             del self._target, self._args, self._kwargs
 
 
+class BackgroundService:
+    """Constructs a service on a background thread and waits for it on first use"""
+
+    def __init__(self, factory) -> None:
+        self._factory = factory
+        self._lock = Lock()
+        self._thread = None
+        self._service = None
+
+    def warm(self):
+        with self._lock:
+            self._start()
+
+    def get_if_ready(self):
+        """Returns the service if it has been constructed, without waiting for it"""
+        return self._service
+
+    def get(self):
+        """Waits for the service. Every caller waiting on a failed attempt gets its error."""
+        with self._lock:
+            # Only calls made after an attempt failed try again
+            if self._thread and not self._thread.is_alive() and self._thread.result:
+                self._thread = None
+            thread = self._start()
+        if thread.is_alive():
+            with tracing.span(self._factory.__name__, "wait"):
+                thread.join()
+        if thread.result:
+            raise thread.result
+        return self._service
+
+    def _start(self) -> Thread:
+        """Starts an attempt unless one exists. Must be called with the lock held."""
+        if not self._thread:
+            # The attempt's error is its result, so every waiter sees the same one
+            self._thread = ResultThread(target=self._construct, daemon=True)
+            self._thread.start()
+        return self._thread
+
+    def _construct(self) -> Exception | None:
+        try:
+            with tracing.span(self._factory.__name__, "service"):
+                self._service = self._factory()
+        except Exception as e:
+            return e
+
+
 def nested_get(dic, keys):
     for key in keys:
         if not isinstance(dic, dict):
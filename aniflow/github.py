@@ -1,35 +1,93 @@
-from datetime import datetime
-from http.client import HTTPException
+import logging
+import os
+import time
 from os import getenv
-from os.path import getmtime
 from pathlib import Path
-from urllib.request import urlretrieve
+from threading import Thread
 
-from common import nested_get
-from requests import get
+from cache import Cache
+from http_session import get_session
+from requests import RequestException
 
+DOWNLOAD_CHUNK_SIZE = 1 << 16
 
-def get_last_commit_date(repo: str, path: str):
-    response = get(
-        f"https://api.github.com/repos/{repo}/commits?path={path}&per_page=1",
-        headers={"Authorization": f"Bearer {getenv('GITHUB_TOKEN')}"},
+refresh_state = Cache("github")
+
+
+def update_file_in_background(
+    repo: str, path: str, local_file_path: Path, on_update=None
+) -> Thread:
+    """Refreshes the local file on a daemon thread and calls on_update if it changed"""
+    thread = Thread(
+        target=update_file_if_necessary,
+        args=[repo, path, local_file_path],
+        kwargs={"on_update": on_update},
+        daemon=True,
     )
-    if response.status_code != 200:
-        raise HTTPException(
-            f"Got status code {response.status_code} for GitHub request."
-        )
-
-    date = nested_get(response.json()[0], ["commit", "committer", "date"])
-    return datetime.strptime(date, "%Y-%m-%dT%H:%M:%SZ")
-
-
-def update_file_if_necessary(repo: str, path: str, local_file_path: Path):
-    if local_file_path.exists():
-        remote_last_updated = get_last_commit_date(repo, path)
-        local_last_updated = datetime.fromtimestamp(getmtime(local_file_path))
-        if local_last_updated > remote_last_updated:
-            return
-    urlretrieve(
-        url=f"https://raw.githubusercontent.com/{repo}/master/{path}",
-        filename=local_file_path,
+    thread.start()
+    return thread
+
+
+def update_file_if_necessary(
+    repo: str, path: str, local_file_path: Path, on_update=None
+) -> bool:
+    """Returns True if the local file was replaced with a newer remote copy.
+
+    An existing local copy is only refreshed once per GITHUB_REFRESH_INTERVAL_HOURS
+    and is kept as is if GITHUB_TOKEN is missing or GitHub can't be reached.
+    """
+    token = getenv("GITHUB_TOKEN")
+    state = refresh_state.get(str(local_file_path)) or {}
+    has_local_copy = local_file_path.exists()
+    if has_local_copy:
+        if not token:
+            return False
+        refresh_interval_hours = float(getenv("GITHUB_REFRESH_INTERVAL_HOURS", 24))
+        if time.time() - state.get("checked_at", 0) < refresh_interval_hours * 3600:
+            return False
+
+    headers = {}
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+    if has_local_copy and state.get("etag"):
+        headers["If-None-Match"] = state["etag"]
+
+    try:
+        with get_session().get(
+            f"https://raw.githubusercontent.com/{repo}/master/{path}",
+            headers=headers,
+            stream=True,
+        ) as response:
+            updated = response.status_code != 304
+            if updated:
+                response.raise_for_status()
+                _download(response, local_file_path)
+    except RequestException as e:
+        if not has_local_copy:
+            raise
+        logging.info(f"Keeping local copy of {path}: {e}")
+        return False
+
+    refresh_state.set(
+        str(local_file_path),
+        {
+            "etag": response.headers.get("ETag", state.get("etag")),
+            "checked_at": time.time(),
+        },
     )
+    if updated and on_update:
+        on_update()
+    return updated
+
+
+def _download(response, local_file_path: Path):
+    """Streams the response to a temporary file and swaps it in atomically"""
+    temp_file_path = local_file_path.with_name(local_file_path.name + ".download")
+    try:
+        with open(temp_file_path, "wb") as temp_file:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                temp_file.write(chunk)
+        os.replace(temp_file_path, local_file_path)
+    finally:
+        if temp_file_path.exists():
+            os.remove(temp_file_path)
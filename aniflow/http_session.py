@@ -0,0 +1,53 @@
+from os import getenv
+from threading import Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+
+_sessions: dict[str, requests.Session] = {}
+_lock = Lock()
+
+
+class Session(requests.Session):
+    """A requests.Session that applies a default timeout to every request"""
+
+    def __init__(self, timeout: float) -> None:
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, *args, timeout=None, **kwargs):
+        return super().request(*args, timeout=timeout or self.timeout, **kwargs)
+
+
+def get_session(name: str = "default") -> requests.Session:
+    """Returns a shared session with pooled keep-alive connections and retries.
+
+    Clients that modify session state, such as praw setting its own User-Agent,
+    should ask for a session under their own name.
+    """
+    with _lock:
+        if name not in _sessions:
+            _sessions[name] = _create_session()
+        return _sessions[name]
+
+
+def _create_session() -> requests.Session:
+    session = Session(timeout=float(getenv("HTTP_TIMEOUT_SECONDS", 30)))
+    retry = Retry(
+        total=int(getenv("HTTP_MAX_RETRIES", 3)),
+        backoff_factor=0.5,
+        status_forcelist=RETRY_STATUS_CODES,
+        # The APIs used are queries or idempotent updates, so POST is safe to retry
+        allowed_methods=None,
+        raise_on_status=False,
+    )
+    pool_size = int(getenv("HTTP_POOL_SIZE", 10))
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
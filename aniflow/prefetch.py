@@ -0,0 +1,217 @@
+import asyncio
+import heapq
+import logging
+from concurrent.futures import CancelledError
+from contextlib import asynccontextmanager
+from itertools import count
+from threading import Thread
+from typing import List
+
+import tracing
+from common import Episode
+
+
+class PrioritySlots:
+    """Limits concurrent pipelines and hands free slots to the lowest priority first"""
+
+    def __init__(self, slots: int) -> None:
+        self._free = slots
+        self._waiters = []
+        # Breaks ties between equal priorities in submission order
+        self._counter = count()
+
+    @asynccontextmanager
+    async def acquire(self, priority: int):
+        if self._free and not self._waiters:
+            self._free -= 1
+        else:
+            waiter = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._waiters, (priority, next(self._counter), waiter))
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # The slot may have been handed over just before cancellation
+                if waiter.done() and not waiter.cancelled():
+                    self._release()
+                raise
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _release(self):
+        while self._waiters:
+            _, _, waiter = heapq.heappop(self._waiters)
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._free += 1
+
+
+class Prefetcher:
+    """Prefetches data for listed episodes as asyncio tasks on a dedicated event loop.
+
+    prefetch is a coroutine function taking an episode and a background flag.
+    is_watched optionally returns whether an episode has been watched, so that
+    unwatched episodes are prefetched first.
+    is_resolved optionally returns whether a prefetched episode has what it
+    needs. Episodes that aren't, or whose prefetch failed, are prefetched again
+    when they are prioritized or submitted again.
+    prepare is an optional coroutine function taking the newly listed episodes,
+    which runs before their prefetches start so that requests can be batched.
+    """
+
+    PRIORITY_URGENT = -1
+
+    def __init__(
+        self,
+        prefetch,
+        max_workers: int,
+        is_watched=None,
+        prepare=None,
+        is_resolved=None,
+    ) -> None:
+        self._prefetch = prefetch
+        self._is_watched = is_watched
+        self._is_resolved = is_resolved
+        self._prepare = prepare
+        self._loop = asyncio.new_event_loop()
+        Thread(target=self._loop.run_forever, daemon=True).start()
+        # Only touched from the event loop thread
+        self._slots = PrioritySlots(max_workers)
+        self._tasks: dict[Episode, asyncio.Task] = {}
+        self._priorities: dict[Episode, int] = {}
+        self._started: set[Episode] = set()
+        self._preparing: asyncio.Task = None
+
+    def submit_all(self, episodes: List[Episode]):
+        """Queues every episode and cancels work for episodes no longer listed"""
+        self._call(self._submit_all(list(self._get_priorities(episodes))))
+
+    def prioritize(self, episode: Episode):
+        """Moves the episode to the front of the queue if it hasn't started yet"""
+        self._call(self._prioritize(episode))
+
+    def result(self, episode: Episode):
+        """Waits for the episode's prefetched data. Returns None if prefetching failed."""
+        try:
+            with tracing.span("prefetch", "wait"):
+                return self._call(self._result(episode))
+        except CancelledError:
+            return None
+        except Exception:
+            logging.exception(f"Failed to prefetch data for {episode}")
+            return None
+
+    def results(self, episodes: List[Episode]) -> list:
+        """Waits for the prefetched data of every episode without reprioritizing them"""
+        results = self._call(self._results(episodes))
+        for i, (episode, result) in enumerate(zip(episodes, results)):
+            if isinstance(result, BaseException):
+                if not isinstance(result, asyncio.CancelledError):
+                    logging.error(
+                        f"Failed to prefetch data for {episode}", exc_info=result
+                    )
+                results[i] = None
+        return results
+
+    def _call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    async def _submit_all(self, priorities: List[tuple[int, Episode]]):
+        listed = {episode for _, episode in priorities}
+        new = [episode for _, episode in priorities if self._needs_run(episode)]
+        if self._prepare and new:
+            self._preparing = asyncio.create_task(self._prepare_all(new))
+        for episode in [e for e in self._tasks if e not in listed]:
+            self._tasks.pop(episode).cancel()
+            self._priorities.pop(episode, None)
+            self._started.discard(episode)
+
+        for priority, episode in priorities:
+            task = self._tasks.get(episode)
+            if (
+                task
+                and not self._needs_run(episode)
+                and (
+                    task.done()
+                    or episode in self._started
+                    or self._priorities[episode] <= priority
+                )
+            ):
+                continue
+            if task:
+                task.cancel()
+            self._started.discard(episode)
+            self._priorities[episode] = priority
+            self._tasks[episode] = asyncio.create_task(self._run(episode, priority))
+
+    async def _prioritize(self, episode: Episode) -> asyncio.Task:
+        task = self._tasks.get(episode)
+        if (
+            task
+            and not self._needs_run(episode)
+            and (task.done() or episode in self._started)
+        ):
+            return task
+        if task:
+            task.cancel()
+        self._started.discard(episode)
+        self._priorities[episode] = self.PRIORITY_URGENT
+        task = self._tasks[episode] = asyncio.create_task(
+            self._run(episode, self.PRIORITY_URGENT)
+        )
+        return task
+
+    def _needs_run(self, episode: Episode) -> bool:
+        """Returns True if the episode has no task, or its task ended without a usable result"""
+        task = self._tasks.get(episode)
+        if not task:
+            return True
+        if not task.done():
+            return False
+        if task.cancelled() or task.exception():
+            return True
+        return bool(self._is_resolved) and not self._is_resolved(episode)
+
+    async def _result(self, episode: Episode):
+        # Shielded so a cancelled wait doesn't cancel the prefetch itself
+        return await asyncio.shield(await self._prioritize(episode))
+
+    async def _prepare_all(self, episodes: List[Episode]):
+        try:
+            await self._prepare(episodes)
+        except Exception:
+            logging.exception("Failed to prepare prefetching")
+
+    async def _results(self, episodes: List[Episode]) -> list:
+        tasks = []
+        for episode in episodes:
+            tasks.append(self._tasks.get(episode) or await self._prioritize(episode))
+        return await asyncio.gather(
+            *map(asyncio.shield, tasks), return_exceptions=True
+        )
+
+    async def _run(self, episode: Episode, priority: int):
+        if self._preparing:
+            # Waited on without cancelling it if this prefetch is cancelled
+            await asyncio.wait([self._preparing])
+        async with self._slots.acquire(priority):
+            self._started.add(episode)
+            with tracing.span(
+                "prefetch", "prefetch", asynchronous=True, episode=str(episode)
+            ):
+                return await self._prefetch(
+                    episode, background=priority != self.PRIORITY_URGENT
+                )
+
+    def _get_priorities(self, episodes: List[Episode]):
+        """Returns (priority, episode) pairs where the first unwatched episode of each show comes first"""
+        shows = {}
+        for episode in episodes:
+            show = (episode.anime_title, episode.season)
+            if self._is_watched and self._is_watched(episode):
+                yield len(episodes) + shows.get(show, 0), episode
+            else:
+                shows[show] = shows.get(show, 0) + 1
+                yield shows[show] - 1, episode
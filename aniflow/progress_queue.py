@@ -0,0 +1,49 @@
+from threading import Lock
+from typing import List
+
+from cache import Cache
+
+
+class ProgressQueue:
+    """Durable queue of AniList progress updates that keeps one update per media id"""
+
+    def __init__(self) -> None:
+        self._cache = Cache("anilist-progress", durable=True)
+        self._lock = Lock()
+
+    def put(self, media_id: int, status: str, progress: int):
+        """Records the update unless a queued update for the media is further along"""
+        update = {"status": status, "progress": progress}
+        with self._lock:
+            queued = self._cache.get(str(media_id))
+            if queued and (queued["progress"], queued["status"] == "COMPLETED") >= (
+                progress,
+                status == "COMPLETED",
+            ):
+                return
+            self._cache.set(str(media_id), update)
+
+    def items(self) -> dict[int, dict]:
+        return {int(media_id): update for media_id, update in self._cache.items().items()}
+
+    def record_failure(self, updates: dict[int, dict], max_attempts: int) -> List[int]:
+        """Counts a failed attempt for each update still queued. Returns the media ids given up on."""
+        given_up = []
+        with self._lock:
+            for media_id, update in updates.items():
+                if self._cache.get(str(media_id)) != update:
+                    continue
+                attempts = update.get("attempts", 0) + 1
+                if attempts >= max_attempts:
+                    self._cache.invalidate(str(media_id))
+                    given_up.append(media_id)
+                else:
+                    self._cache.set(str(media_id), {**update, "attempts": attempts})
+        return given_up
+
+    def remove(self, updates: dict[int, dict]):
+        """Removes the sent updates, keeping any that were replaced in the meantime"""
+        with self._lock:
+            for media_id, update in updates.items():
+                if self._cache.get(str(media_id)) == update:
+                    self._cache.invalidate(str(media_id))
@@ -13,6 +13,14 @@ def confirm(message, default=True):
     )
 
 
+def checkbox(message, choices, default=None):
+    return _prompt(
+        inquirer.Checkbox(
+            KEY, message=message, choices=choices, default=default or [], carousel=True
+        )
+    )
+
+
 def list(message, choices):
     return _prompt(inquirer.List(KEY, message=message, choices=choices, carousel=True))
 
@@ -1,8 +1,14 @@
+import logging
 import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from mimetypes import guess_type
 from os import getenv
 from pathlib import Path
+from typing import List
 
+import common
+from cache import Cache
 from common import Episode
 from qbittorrentapi import Client
 
@@ -12,19 +18,59 @@ class Qbittorrent:
     # https://github.com/qbittorrent/qBittorrent/wiki/WebUI-API-(qBittorrent-4.1)#get-torrent-contents
     PROGRESS_COMPLETE = 1
     PRIORITY_DO_NOT_DOWNLOAD = 0
+    CATEGORY = "Anime"
+    # Torrent fields whose changes may change the torrent's file list
+    SYNC_KEYS = ("progress", "state", "save_path")
 
     def __init__(self) -> None:
+        max_workers = int(getenv("QBITTORRENT_MAX_WORKERS", 8))
         self.client = Client(
             host=getenv("QBITTORRENT_HOST"),
             username=getenv("QBITTORRENT_USERNAME"),
             password=getenv("QBITTORRENT_PASSWORD"),
+            # Let every worker keep its own connection in the shared session
+            HTTPADAPTER_ARGS={"pool_maxsize": max_workers},
         )
-        self.torrents = {}
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="qbittorrent"
+        )
+        # State mirrored from sync/maindata, updated incrementally using the response ID
+        self._rid = 0
+        self._torrents: dict[str, dict] = {}
+        self._files: dict[str, list] = {}
+        # Episodes keyed by (torrent hash, file index) so they are stable across reloads
+        self._episodes: dict[tuple[str, int], Episode] = {}
+
+        self._parse_cache = None
+        if getenv("PERSIST_PARSE_CACHE"):
+            self._parse_cache = Cache("parsed-file-names")
+            common.parsed_file_names.update(self._parse_cache.items())
+        self._persisted_file_names = set(common.parsed_file_names)
 
     def get_episodes(self):
+        changed = list(self._sync())
+        for torrent_hash, files in zip(
+            changed, self._executor.map(self._get_torrent_files, changed)
+        ):
+            self._files[torrent_hash] = files
+
+        torrents = [
+            torrent
+            for torrent in self._torrents.values()
+            if torrent.get("category") == self.CATEGORY
+        ]
         episodes = []
-        for torrent in self._get_torrents():
-            episodes.extend(self._get_episodes_per_torrent(torrent))
+        for torrent, files in zip(
+            torrents, self._executor.map(self._filter_torrent_files, torrents)
+        ):
+            episodes.extend(self._get_episodes_per_torrent(torrent, files))
+
+        listed = {(episode.torrent_hash, episode.index) for episode in episodes}
+        for key in [key for key in self._episodes if key not in listed]:
+            del self._episodes[key]
+        common.prune_parsed_file_names(episodes)
+        self._persist_parsed_file_names()
+
         return sorted(
             episodes,
             key=lambda ep: (
@@ -36,42 +82,120 @@ class Qbittorrent:
         )
 
     def delete(self, episode: Episode):
-        if episode.can_delete_torrent:
-            self.torrents[episode].delete(delete_files=True)
+        self.delete_many([episode])
+
+    def delete_many(self, episodes: List[Episode]):
+        """Deletes single file torrents in one call and skips the other files per torrent.
+
+        Skipped files are removed from disk in the background.
+        """
+        torrent_hashes = set()
+        file_ids = defaultdict(list)
+        for episode in episodes:
+            if episode.can_delete_torrent:
+                torrent_hashes.add(episode.torrent_hash)
+            else:
+                file_ids[episode.torrent_hash].append(episode.index)
+
+        if torrent_hashes:
+            self.client.torrents_delete(
+                delete_files=True, torrent_hashes=list(torrent_hashes)
+            )
+        for torrent_hash, ids in file_ids.items():
+            self.client.torrents_file_priority(
+                torrent_hash=torrent_hash,
+                file_ids=ids,
+                priority=self.PRIORITY_DO_NOT_DOWNLOAD,
+            )
+        for episode in episodes:
+            if not episode.can_delete_torrent:
+                self._executor.submit(self._remove_file, episode.path)
+            # File priorities don't show up in sync/maindata, so force a refetch
+            self._files.pop(episode.torrent_hash, None)
+
+    def _remove_file(self, path: str):
+        try:
+            os.remove(path)
+        except OSError as e:
+            logging.warning(f"Failed to delete {path}: {e}")
+
+    def _persist_parsed_file_names(self):
+        if not self._parse_cache:
+            return
+        for file_name in self._persisted_file_names - set(common.parsed_file_names):
+            self._parse_cache.invalidate(file_name)
+        self._persisted_file_names &= set(common.parsed_file_names)
+        new_file_names = {
+            file_name: details
+            for file_name, details in common.parsed_file_names.items()
+            if file_name not in self._persisted_file_names
+        }
+        if new_file_names:
+            self._parse_cache.set_many(new_file_names)
+            self._persisted_file_names.update(new_file_names)
+
+    def _sync(self) -> set[str]:
+        """Applies changes since the last sync and returns the hashes whose files need fetching"""
+        maindata = self.client.sync_maindata(rid=self._rid)
+        self._rid = maindata.get("rid", 0)
+        updates = maindata.get("torrents") or {}
+
+        if maindata.get("full_update"):
+            removed = set(self._torrents) - set(updates)
         else:
-            self.torrents[episode].file_priority(file_ids=episode.index, priority=0)
-            os.remove(episode.path)
+            removed = set(maindata.get("torrents_removed") or [])
+        for torrent_hash in removed:
+            self._torrents.pop(torrent_hash, None)
+            self._files.pop(torrent_hash, None)
+
+        for torrent_hash, fields in updates.items():
+            previous = self._torrents.get(torrent_hash, {})
+            torrent = {**previous, **fields, "hash": torrent_hash}
+            self._torrents[torrent_hash] = torrent
+            if any(torrent.get(key) != previous.get(key) for key in self.SYNC_KEYS):
+                self._files.pop(torrent_hash, None)
 
-    def _get_torrents(self):
-        return self.client.torrents_info(category="Anime", sort="name")
+        return {
+            torrent_hash
+            for torrent_hash, torrent in self._torrents.items()
+            if torrent.get("category") == self.CATEGORY
+            and torrent_hash not in self._files
+        }
 
-    def _get_episodes_per_torrent(self, torrent):
+    def _get_torrent_files(self, torrent_hash: str):
+        return self.client.torrents_files(torrent_hash=torrent_hash)
+
+    def _get_episodes_per_torrent(self, torrent: dict, files):
         episodes = []
-        files = self._filter_torrent_files(torrent)
         is_torrent_with_single_file = len(files) == 1
         for file in files:
-            episode = Episode(
-                file.index,
-                file.name,
-                str(Path(torrent.save_path) / file.name),
-                torrent.hash,
-                can_delete_torrent=is_torrent_with_single_file,
-            )
+            key = (torrent["hash"], file.index)
+            path = str(Path(torrent["save_path"]) / file.name)
+            episode = self._episodes.get(key)
+            if not episode or episode.path != path:
+                episode = Episode(
+                    file.index,
+                    file.name,
+                    path,
+                    torrent["hash"],
+                    can_delete_torrent=is_torrent_with_single_file,
+                )
+                self._episodes[key] = episode
+            episode.can_delete_torrent = is_torrent_with_single_file
             episodes.append(episode)
-            self.torrents[episode] = torrent
         return episodes
 
     def _is_video_file(self, path):
         return guess_type(path)[0].startswith("video")
 
-    def _filter_torrent_files(self, torrent):
+    def _filter_torrent_files(self, torrent: dict):
         files = []
-        for file in torrent.files:
+        for file in self._files.get(torrent["hash"], []):
             if (
                 file.get("progress") == self.PROGRESS_COMPLETE
                 and file.priority != self.PRIORITY_DO_NOT_DOWNLOAD
             ):
-                path = Path(torrent.save_path) / file.name
+                path = Path(torrent["save_path"]) / file.name
                 if path.exists() and self._is_video_file(path):
                     files.append(file)
         return files
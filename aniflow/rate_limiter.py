@@ -0,0 +1,74 @@
+import time
+from threading import Condition
+
+
+class RateLimiter:
+    """Token bucket that spaces out requests and lets interactive requests go first.
+
+    Background requests leave a reserve of tokens for interactive ones and always
+    yield to interactive requests that are waiting.
+    """
+
+    def __init__(self, requests_per_minute: int, reserve_ratio: float = 0.2) -> None:
+        self._condition = Condition()
+        self._reserve_ratio = reserve_ratio
+        self._set_limit(requests_per_minute)
+        self._tokens = float(self._capacity)
+        self._updated_at = time.monotonic()
+        self._blocked_until = 0
+        self._interactive_waiting = 0
+
+    def acquire(self, background: bool = False):
+        with self._condition:
+            if not background:
+                self._interactive_waiting += 1
+            try:
+                while (timeout := self._get_wait_time(background)) != 0:
+                    self._condition.wait(timeout)
+                self._tokens -= 1
+            finally:
+                if not background:
+                    self._interactive_waiting -= 1
+                    self._condition.notify_all()
+
+    def update(self, headers):
+        """Applies the X-RateLimit-* and Retry-After headers of a response"""
+        with self._condition:
+            limit = headers.get("X-RateLimit-Limit")
+            if limit and int(limit) != self._capacity:
+                self._set_limit(int(limit))
+            remaining = headers.get("X-RateLimit-Remaining")
+            if remaining is not None:
+                self._refill()
+                self._tokens = min(self._tokens, float(remaining))
+            retry_after = headers.get("Retry-After")
+            if retry_after is not None:
+                self._tokens = 0
+                self._blocked_until = time.monotonic() + float(retry_after)
+            self._condition.notify_all()
+
+    def _get_wait_time(self, background: bool):
+        """Returns 0 if a token can be taken now, otherwise how long to wait or None to wait for a notification"""
+        if background and self._interactive_waiting:
+            return None
+
+        now = time.monotonic()
+        if now < self._blocked_until:
+            return self._blocked_until - now
+
+        self._refill()
+        needed = 1 + (self._capacity * self._reserve_ratio if background else 0)
+        if self._tokens >= needed:
+            return 0
+        return (needed - self._tokens) / self._rate
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(
+            self._capacity, self._tokens + (now - self._updated_at) * self._rate
+        )
+        self._updated_at = now
+
+    def _set_limit(self, requests_per_minute: int):
+        self._capacity = requests_per_minute
+        self._rate = requests_per_minute / 60
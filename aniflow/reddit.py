@@ -1,15 +1,40 @@
+import re
+import time
 import urllib
+from datetime import timedelta
 from os import getenv
+from threading import Thread
 
 import praw
 import requests
+from cache import Cache
 from common import Episode
+from http_session import get_session
 from praw.models import Submission
 import logging
 
 
+class Discussion:
+    """An r/anime discussion thread that can be upvoted without fetching it first"""
+
+    def __init__(self, submission: Submission, url: str) -> None:
+        self.submission = submission
+        self.url = url
+
+    def upvote(self):
+        self.submission.upvote()
+
+
 class Reddit:
 
+    SEARCH_LIMIT = 10
+    HARVEST_LIMIT = 500
+    # e.g. "Sousou no Frieren • Frieren: Beyond Journey's End - Episode 10 discussion"
+    DISCUSSION_TITLE_PATTERN = re.compile(
+        r"^(?P<titles>.+?) - Episode (?P<episode>\d+(?:\.\d+)?) discussion",
+        re.IGNORECASE,
+    )
+
     def __init__(self) -> None:
         self.USERNAME = getenv("REDDIT_USERNAME")
         self.PASSWORD = getenv("REDDIT_PASSWORD")
@@ -17,31 +42,82 @@ class Reddit:
         self.APP_CLIENT_ID = getenv("REDDIT_APP_CLIENT_ID")
         self.APP_CLIENT_SECRET = getenv("REDDIT_APP_CLIENT_SECRET")
 
+        # praw sets its own User-Agent on the session, so keep it separate
+        self.session = get_session("reddit")
         self.reddit_token = self._get_reddit_token()
-        reddit = praw.Reddit(
+        self.reddit = praw.Reddit(
             client_id=self.APP_CLIENT_ID,
             client_secret=self.APP_CLIENT_SECRET,
             user_agent=self.USER_AGENT,
             username=self.USERNAME,
             password=self.PASSWORD,
+            requestor_kwargs={"session": self.session},
+        )
+        self.anime_subreddit = self.reddit.subreddit("anime")
+        self.discussion_cache = Cache("reddit-discussions")
+        # Episode discussions harvested in bulk, keyed by normalized title and episode
+        self.harvested_discussions = Cache(
+            "reddit-harvested-discussions",
+            ttl=timedelta(days=int(getenv("REDDIT_HARVEST_TTL_DAYS", 30))),
         )
-        self.anime_subreddit = reddit.subreddit("anime")
-
-    def find_discussion(
-        self, episode: Episode, use_synonyms: bool = False
-    ) -> Submission:
-        query = self._create_reddit_search_query(episode, use_synonyms)
-        if query:
-            submissions = self.anime_subreddit.search(query)
-            submission = next(submissions, None)
-            # Return here if there is only a single matching submission
-            if submission and not next(submissions, None):
-                return submission
-            elif not use_synonyms:
-                logging.info("Could not find exact Reddit thread")
-                return self.find_discussion(episode, use_synonyms=True)
-            else:
-                return None
+        self.harvest_state = Cache("reddit-harvest-state")
+        Thread(target=self._harvest_discussions_periodically, daemon=True).start()
+
+    def find_discussion(self, episode: Episode) -> Discussion | None:
+        if not episode.anilist_entry:
+            return None
+
+        cache_key = f"{episode.anilist_entry.id}:{episode.episode_number}"
+        cached = self.discussion_cache.get(cache_key)
+        if cached:
+            return Discussion(self.reddit.submission(id=cached["id"]), cached["url"])
+
+        harvested = self._find_harvested_discussion(episode)
+        if harvested:
+            self.discussion_cache.set(cache_key, harvested)
+            return Discussion(
+                self.reddit.submission(id=harvested["id"]), harvested["url"]
+            )
+
+        query = self._create_reddit_search_query(episode)
+        submissions = self.anime_subreddit.search(query, limit=self.SEARCH_LIMIT)
+        submission = self._pick_discussion(episode, list(submissions))
+        if not submission:
+            logging.info("Could not find exact Reddit thread")
+            return None
+
+        self.discussion_cache.set(cache_key, {"id": submission.id, "url": submission.url})
+        return Discussion(submission, submission.url)
+
+    def harvest_discussions(self):
+        """Indexes episode discussions posted since the last harvest"""
+        harvested_since = self.harvest_state.get("newest_created_utc") or 0
+        newest_created_utc = harvested_since
+        harvested = {}
+        # The listing is strictly newest first, which search results aren't
+        for submission in self.anime_subreddit.new(limit=self.HARVEST_LIMIT):
+            if submission.created_utc <= harvested_since:
+                break
+            if (submission.link_flair_text or "").lower() != "episode":
+                continue
+            match = self.DISCUSSION_TITLE_PATTERN.match(submission.title)
+            if not match:
+                continue
+            episode_number = f"{float(match.group('episode')):g}"
+            for title in match.group("titles").split(" • "):
+                harvested[self._get_harvest_key(title, episode_number)] = {
+                    "id": submission.id,
+                    "url": submission.url,
+                }
+            newest_created_utc = max(newest_created_utc, submission.created_utc)
+
+        if harvested:
+            self.harvested_discussions.set_many(harvested)
+        # Most harvested titles are never looked up, so they wouldn't expire on read
+        self.harvested_discussions.purge_expired()
+        self.harvest_state.set("newest_created_utc", newest_created_utc)
+        self.harvest_state.set("harvested_at", time.time())
+        logging.debug(f"Harvested {len(harvested)} Reddit discussion titles")
 
     def get_generic_search_url(self, episode: Episode) -> str:
         query = [
@@ -68,7 +144,7 @@ class Reddit:
             "password": self.PASSWORD,
         }
         headers = {"User-Agent": self.USER_AGENT}
-        response = requests.post(
+        response = self.session.post(
             "https://www.reddit.com/api/v1/access_token",
             auth=client_auth,
             data=post_data,
@@ -76,23 +152,89 @@ class Reddit:
         )
         return response.json().get("access_token")
 
-    def _create_reddit_search_query(
-        self, episode: Episode, use_synonyms=False
-    ) -> str | None:
+    def _harvest_discussions_periodically(self):
+        interval = float(getenv("REDDIT_HARVEST_INTERVAL_MINUTES", 30)) * 60
+        while True:
+            harvested_at = self.harvest_state.get("harvested_at") or 0
+            wait = harvested_at + interval - time.time()
+            if wait > 0:
+                time.sleep(wait)
+                continue
+            try:
+                self.harvest_discussions()
+            except Exception:
+                logging.exception("Failed to harvest Reddit discussions")
+                time.sleep(interval)
+
+    def _find_harvested_discussion(self, episode: Episode) -> dict | None:
+        titles = episode.anilist_entry.titles + episode.anilist_entry.synonyms
+        for episode_number in self._get_episode_numbers(episode):
+            for title in titles:
+                harvested = self.harvested_discussions.get(
+                    self._get_harvest_key(title, episode_number)
+                )
+                if harvested:
+                    return harvested
+        return None
+
+    def _get_harvest_key(self, title: str, episode_number: str) -> str:
+        return f"{self._normalize(title)}:{episode_number}"
+
+    def _pick_discussion(
+        self, episode: Episode, submissions: list[Submission]
+    ) -> Submission | None:
+        """Returns the best submission for the episode, or None if it is ambiguous.
+
+        Sequels share their base title and episode numbers, so the titles of a
+        discussion have to equal one of the entry's titles or synonyms.
+        """
+        episode_numbers = set(self._get_episode_numbers(episode))
+        titles = {self._normalize(title) for title in episode.anilist_entry.titles}
+        synonyms = {self._normalize(title) for title in episode.anilist_entry.synonyms}
+
+        candidates = []
+        for submission in submissions:
+            match = self.DISCUSSION_TITLE_PATTERN.match(submission.title)
+            if not match:
+                continue
+            episode_number = f"{float(match.group('episode')):g}"
+            if episode_numbers and episode_number not in episode_numbers:
+                continue
+            discussion_titles = {
+                self._normalize(title) for title in match.group("titles").split(" • ")
+            }
+            if discussion_titles & titles:
+                candidates.append((2, submission))
+            elif discussion_titles & synonyms:
+                candidates.append((1, submission))
+
+        if not candidates:
+            return None
+        best_score = max(score for score, _ in candidates)
+        best = [submission for score, submission in candidates if score == best_score]
+        if len(best) > 1:
+            return None
+        return best[0]
+
+    def _create_reddit_search_query(self, episode: Episode) -> str | None:
         if not episode.anilist_entry:
             return None
 
-        titles = episode.anilist_entry.titles
-        if use_synonyms and episode.anilist_entry.synonyms:
-            titles.extend(episode.anilist_entry.synonyms)
+        titles = episode.anilist_entry.titles + episode.anilist_entry.synonyms
         title_terms = " OR ".join({f'"{title}"' for title in titles})
         query = f"flair:episode (selftext:({title_terms}) OR title:({title_terms}))"
 
-        episode_numbers = filter(
-            None, [episode.episode_number, episode.absolute_episode_number]
-        )
+        episode_numbers = self._get_episode_numbers(episode)
         episode_terms = " OR ".join([f'"Episode {n}"' for n in episode_numbers])
         if episode_terms:
             query += f" title:({episode_terms})"
 
         return query
+
+    def _get_episode_numbers(self, episode: Episode) -> list[str]:
+        return list(
+            filter(None, [episode.episode_number, episode.absolute_episode_number])
+        )
+
+    def _normalize(self, title: str) -> str:
+        return "".join(filter(str.isalnum, title.lower()))
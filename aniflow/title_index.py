@@ -0,0 +1,55 @@
+from collections import Counter, defaultdict
+from threading import Lock
+
+from common import AniListEntry
+
+
+class TitleIndex:
+    """Offline fuzzy lookup of AniList entries by title using trigram posting lists"""
+
+    # Only the entries sharing the most trigrams with the query are scored
+    MAX_CANDIDATES = 20
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._postings: dict[str, set[int]] = defaultdict(set)
+        self._titles: dict[int, dict[frozenset[str], str]] = defaultdict(dict)
+        self._entries: dict[int, AniListEntry] = {}
+
+    def add(self, entry: AniListEntry):
+        with self._lock:
+            self._entries[entry.id] = entry
+            for title in (entry.titles or []) + (entry.synonyms or []):
+                trigrams = self._get_trigrams(title)
+                if not trigrams or trigrams in self._titles[entry.id]:
+                    continue
+                self._titles[entry.id][trigrams] = title
+                for trigram in trigrams:
+                    self._postings[trigram].add(entry.id)
+
+    def search(self, title: str) -> tuple[AniListEntry, float, str] | None:
+        """Returns the most similar entry, its Dice similarity between 0 and 1 and the title that matched"""
+        query = self._get_trigrams(title)
+        if not query:
+            return None
+
+        with self._lock:
+            shared = Counter()
+            for trigram in query:
+                shared.update(self._postings.get(trigram, ()))
+
+            best = None
+            for id, _ in shared.most_common(self.MAX_CANDIDATES):
+                for trigrams, matched_title in self._titles[id].items():
+                    score = 2 * len(query & trigrams) / (len(query) + len(trigrams))
+                    if not best or score > best[1]:
+                        best = (self._entries[id], score, matched_title)
+            return best
+
+    def _get_trigrams(self, title: str) -> frozenset[str]:
+        normalized = "".join(filter(str.isalnum, title.lower()))
+        if not normalized:
+            return frozenset()
+        # Pad so that short titles still produce trigrams and the start weighs more
+        padded = f"  {normalized} "
+        return frozenset(padded[i : i + 3] for i in range(len(padded) - 2))
@@ -1,54 +1,85 @@
-import json
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 from os import getenv
 
 import github
 import tmdbsimple as tmdb
+from anime_id_index import AnimeIdIndex
+from cache import Cache
 from common import Episode, get_root_dir
+from http_session import get_session
 
 
 class TMDB:
 
-    tmdb_to_anilist = defaultdict(list)
-    types = {"TV", "SPECIALS"}
     ANIME_ID_DB_FILE_NAME = "anime-list-full.json"
+    # Number of search results whose seasons are fetched at the same time
+    SEASON_LOOKUP_BATCH_SIZE = 5
 
     def __init__(self) -> None:
         anime_id_db_path = get_root_dir() / self.ANIME_ID_DB_FILE_NAME
-        github.update_file_if_necessary(
+        if not anime_id_db_path.exists():
+            github.update_file_if_necessary(
+                repo="Fribb/anime-lists",
+                path=self.ANIME_ID_DB_FILE_NAME,
+                local_file_path=anime_id_db_path,
+            )
+        self.anime_id_index = AnimeIdIndex(anime_id_db_path)
+        github.update_file_in_background(
             repo="Fribb/anime-lists",
             path=self.ANIME_ID_DB_FILE_NAME,
             local_file_path=anime_id_db_path,
+            on_update=self.anime_id_index.load,
         )
-        with open(anime_id_db_path, "r") as anime_id_db:
-            for entry in json.load(anime_id_db):
-                anilist_id = entry.get("anilist_id")
-                tmdb_id = entry.get("themoviedb_id")
-                type = entry.get("type")
-                if anilist_id and tmdb_id and type in self.types:
-                    self.tmdb_to_anilist[tmdb_id].append(anilist_id)
         tmdb.API_KEY = getenv("TMDB_API_KEY")
+        tmdb.REQUESTS_SESSION = get_session()
+
+        ttl = timedelta(days=int(getenv("TMDB_CACHE_TTL_DAYS", 7)))
+        self.search_cache = Cache("tmdb-search", ttl=ttl)
+        self.seasons_cache = Cache("tmdb-seasons", ttl=ttl)
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.SEASON_LOOKUP_BATCH_SIZE, thread_name_prefix="tmdb"
+        )
 
     def search(self, episode: Episode):
-        search_results = tmdb.Search().tv(query=episode.anime_title).get("results")
-        for result in search_results:
-            id = result.get("id")
-            seasons = self._get_seasons(id)
-            ep_number = int(episode.episode_number)
-            for season_num, ep_count, abs_ep_range in seasons:
-                start, end = abs_ep_range
-                if episode.season and episode.season == season_num:
-                    if ep_number <= ep_count:
-                        return self._get_anilist_entries(id), start + ep_number - 1
-                if ep_number <= end:
-                    return self._get_anilist_entries(id), ep_number
+        # Seasons are only counted in whole episodes
+        if not episode.episode_number or not episode.episode_number.isdigit():
+            return None, None
+        ids = self._search_ids(episode.anime_title)
+        ep_number = int(episode.episode_number)
+        for batch_start in range(0, len(ids), self.SEASON_LOOKUP_BATCH_SIZE):
+            batch = ids[batch_start : batch_start + self.SEASON_LOOKUP_BATCH_SIZE]
+            for id, seasons in zip(batch, self._executor.map(self._get_seasons, batch)):
+                for season_num, ep_count, abs_ep_range in seasons:
+                    start, end = abs_ep_range
+                    if episode.season and episode.season == season_num:
+                        if ep_number <= ep_count:
+                            return self._get_anilist_entries(id), start + ep_number - 1
+                    if ep_number <= end:
+                        return self._get_anilist_entries(id), ep_number
         return None, None
 
+    def _search_ids(self, title: str):
+        cache_key = title.lower()
+        ids = self.search_cache.get(cache_key)
+        if ids is None:
+            search_results = tmdb.Search().tv(query=title).get("results")
+            ids = [result.get("id") for result in search_results]
+            self.search_cache.set(cache_key, ids)
+        return ids
+
     def _get_seasons(self, tmdb_id):
         if not tmdb_id:
             print("Missing ID")
             return []
 
+        seasons = self.seasons_cache.get(str(tmdb_id))
+        if seasons is None:
+            seasons = self._fetch_seasons(tmdb_id)
+            self.seasons_cache.set(str(tmdb_id), seasons)
+        return seasons
+
+    def _fetch_seasons(self, tmdb_id):
         entry = tmdb.TV(tmdb_id)
 
         seasons = []
@@ -75,4 +106,4 @@ class TMDB:
         return seasons
 
     def _get_anilist_entries(self, tmdb_id: int):
-        return self.tmdb_to_anilist[tmdb_id]
+        return self.anime_id_index.get(tmdb_id)
@@ -0,0 +1,149 @@
+import atexit
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+from itertools import count
+from pathlib import Path
+from urllib.parse import urlsplit
+
+import requests
+
+SUMMARY_LINES = 15
+
+_tracer = None
+
+
+class Tracer:
+    """Records timed spans and exports them as Chrome trace events"""
+
+    def __init__(self) -> None:
+        self._started_at = time.perf_counter()
+        self._events = []
+        self._thread_names: dict[int, str] = {}
+        # Calls, total and longest duration per category and host or span name
+        self._totals = defaultdict(lambda: [0, 0.0, 0.0])
+        self._lock = threading.Lock()
+        self._ids = count()
+
+    @contextmanager
+    def span(self, name: str, category: str, asynchronous=False, **args):
+        """Records the time spent in the block. Asynchronous spans may overlap on one thread."""
+        started_at = time.perf_counter()
+        try:
+            yield args
+        finally:
+            self.record(name, category, started_at, asynchronous=asynchronous, **args)
+
+    def record(
+        self, name: str, category: str, started_at: float, asynchronous=False, **args
+    ):
+        duration = time.perf_counter() - started_at
+        thread = threading.current_thread()
+        event = {
+            "name": name,
+            "cat": category,
+            "ts": (started_at - self._started_at) * 1e6,
+            "pid": os.getpid(),
+            "tid": thread.ident,
+            "args": args,
+        }
+        if asynchronous:
+            id = next(self._ids)
+            events = [
+                {**event, "ph": "b", "id": id},
+                {**event, "ph": "e", "id": id, "ts": event["ts"] + duration * 1e6},
+            ]
+        else:
+            events = [{**event, "ph": "X", "dur": duration * 1e6}]
+        with self._lock:
+            self._thread_names[thread.ident] = thread.name
+            self._events.extend(events)
+            totals = self._totals[(category, args.get("host") or name)]
+            totals[0] += 1
+            totals[1] += duration
+            totals[2] = max(totals[2], duration)
+
+    def trace_http(self):
+        """Records every request sent through requests, which all of the service clients use"""
+        send = requests.Session.send
+
+        @wraps(send)
+        def traced_send(session, request, **kwargs):
+            started_at = time.perf_counter()
+            response = None
+            try:
+                response = send(session, request, **kwargs)
+                return response
+            finally:
+                url = urlsplit(request.url)
+                self.record(
+                    f"{request.method} {url.hostname}{url.path}",
+                    "http",
+                    started_at,
+                    host=url.hostname,
+                    endpoint=url.path,
+                    status=response.status_code if response is not None else None,
+                    bytes=self._get_response_size(response, kwargs.get("stream")),
+                )
+
+        requests.Session.send = traced_send
+
+    def export(self, path: Path):
+        with self._lock:
+            metadata = [
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": os.getpid(),
+                    "tid": tid,
+                    "args": {"name": name},
+                }
+                for tid, name in self._thread_names.items()
+            ]
+            events = metadata + self._events
+        with open(path, "w") as trace_file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, trace_file)
+
+    def summarize(self) -> str:
+        """Returns the total time per state, host and wait, longest first"""
+        with self._lock:
+            totals = sorted(self._totals.items(), key=lambda item: item[1][1], reverse=True)
+        return "\n".join(
+            f"{category:<8} {name:<32} {calls:>5} calls {total:>8.2f}s total {longest:>7.2f}s max"
+            for (category, name), (calls, total, longest) in totals[:SUMMARY_LINES]
+        )
+
+    def _get_response_size(self, response, stream: bool) -> int | None:
+        if response is None:
+            return None
+        content_length = response.headers.get("Content-Length")
+        if content_length:
+            return int(content_length)
+        # Reading a streamed body here would load it all into memory
+        return None if stream else len(response.content)
+
+
+def enable(path: Path) -> Tracer:
+    """Starts tracing and writes the trace and a summary when the program exits"""
+    global _tracer
+    _tracer = Tracer()
+    _tracer.trace_http()
+    atexit.register(_finish, _tracer, path)
+    return _tracer
+
+
+def span(name: str, category: str, asynchronous=False, **args):
+    """Times the block if tracing is enabled"""
+    if not _tracer:
+        return nullcontext(args)
+    return _tracer.span(name, category, asynchronous=asynchronous, **args)
+
+
+def _finish(tracer: Tracer, path: Path):
+    tracer.export(path)
+    print(tracer.summarize())
+    print(f"Trace written to {path}")
@@ -0,0 +1,342 @@
+import argparse
+import atexit
+import importlib.util
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from threading import Event, Lock
+
+ANIFLOW_DIR = Path(__file__).resolve().parent.parent / "aniflow"
+sys.path.insert(0, str(ANIFLOW_DIR))
+
+import cache
+import common
+import http_session
+import tmdb
+from anilist import AniList
+from common import Franchise
+from fake_services import (
+    EPISODES_PER_SEASON,
+    FakeAniList,
+    FakeQbittorrent,
+    FakeReddit,
+    FakeTmdb,
+    get_franchise_id,
+    redirect,
+)
+from qbittorrent import Qbittorrent
+
+
+def load_aniflow():
+    """Imports the AniFlow application module without loading the user's .env"""
+    spec = importlib.util.spec_from_file_location("aniflow_main", ANIFLOW_DIR / "__main__.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.load_dotenv = lambda: None
+    return module
+
+
+aniflow_main = load_aniflow()
+
+
+class TimedAniFlow(aniflow_main.AniFlow):
+    """AniFlow that records when each episode's prefetch finishes"""
+
+    def __init__(self):
+        self.prefetched_at = {}
+        self.prefetch_errors = 0
+        self.all_prefetched = Event()
+        self.expected_prefetches = None
+        self._prefetched_lock = Lock()
+        super().__init__()
+
+    async def prefetch_data(self, episode, background=False):
+        try:
+            return await super().prefetch_data(episode, background=background)
+        except Exception:
+            with self._prefetched_lock:
+                self.prefetch_errors += 1
+            raise
+        finally:
+            with self._prefetched_lock:
+                self.prefetched_at[episode] = time.perf_counter()
+                if len(self.prefetched_at) == self.expected_prefetches:
+                    self.all_prefetched.set()
+
+
+class Services:
+    """Fake stand-ins for every external service, sharing one temporary workspace"""
+
+    def __init__(self, args, torrent_count: int) -> None:
+        self.workspace = Path(tempfile.mkdtemp(prefix="aniflow-benchmark-"))
+        atexit.register(shutil.rmtree, self.workspace, ignore_errors=True)
+        show_count = max(1, -(-torrent_count // EPISODES_PER_SEASON))
+        latency = args.latency_ms / 1000
+        self.qbittorrent = FakeQbittorrent(
+            torrent_count, self.workspace / "downloads", latency=latency
+        )
+        self.anilist = FakeAniList(
+            latency=args.anilist_latency_ms / 1000,
+            requests_per_minute=args.anilist_rate_limit,
+        )
+        self.tmdb = FakeTmdb(latency=latency)
+        self.reddit = FakeReddit(show_count, latency=latency)
+
+        (self.workspace / tmdb.TMDB.ANIME_ID_DB_FILE_NAME).write_text(
+            json.dumps(FakeTmdb.get_anime_id_db(show_count))
+        )
+        self._configure_aniflow()
+
+    def _configure_aniflow(self):
+        os.environ.update(
+            {
+                "QBITTORRENT_HOST": self.qbittorrent.url,
+                "QBITTORRENT_USERNAME": "benchmark",
+                "QBITTORRENT_PASSWORD": "benchmark",
+                "REDDIT_USERNAME": "benchmark",
+                "REDDIT_PASSWORD": "benchmark",
+                "REDDIT_USER_AGENT": "aniflow-benchmark",
+                "REDDIT_APP_CLIENT_ID": "benchmark",
+                "REDDIT_APP_CLIENT_SECRET": "benchmark",
+                "ANILIST_TOKEN": "",
+                "TMDB_API_KEY": "benchmark",
+                "GITHUB_TOKEN": "",
+                "PERSIST_PARSE_CACHE": "",
+            }
+        )
+        # Keeps the cache and the anime id database out of the project root
+        with cache.Cache._lock:
+            if cache.Cache._connection:
+                cache.Cache._connection.close()
+            cache.Cache._connection = None
+        cache.get_root_dir = lambda: self.workspace
+        tmdb.get_root_dir = lambda: self.workspace
+        common.parsed_file_names.clear()
+
+        routes = {
+            AniList.GRAPHQL_URL: self.anilist,
+            "https://api.themoviedb.org": self.tmdb,
+            "https://www.reddit.com": self.reddit,
+            "https://oauth.reddit.com": self.reddit,
+        }
+        redirect(http_session.get_session(), routes)
+        redirect(http_session.get_session("reddit"), routes)
+
+    def reset_request_counts(self):
+        for service in (self.qbittorrent, self.anilist, self.tmdb, self.reddit):
+            service.request_count = 0
+        self.anilist.rate_limited_count = 0
+
+    def get_request_counts(self) -> dict:
+        return {
+            "qbittorrent": self.qbittorrent.request_count,
+            "anilist": self.anilist.request_count,
+            "anilist_rate_limited": self.anilist.rate_limited_count,
+            "tmdb": self.tmdb.request_count,
+            "reddit": self.reddit.request_count,
+        }
+
+
+def summarize(samples: list[float]) -> dict:
+    return {
+        "min": min(samples),
+        "median": statistics.median(samples),
+        "max": max(samples),
+        "samples": samples,
+    }
+
+
+def wait_for_harvest(reddit, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while not reddit.harvest_state.get("harvested_at") and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def benchmark_startup(args) -> dict:
+    """Time until the episode list can be shown and until each service is ready"""
+    measurements = {
+        "init_seconds": [],
+        "episode_list_seconds": [],
+        "anilist_ready_seconds": [],
+        "reddit_ready_seconds": [],
+    }
+    for _ in range(args.repeat):
+        Services(args, args.prefetch_torrents)
+        started_at = time.perf_counter()
+        flow = TimedAniFlow()
+        measurements["init_seconds"].append(time.perf_counter() - started_at)
+        flow._anilist.warm()
+        flow._reddit.warm()
+        flow.qbittorrent.get_episodes()
+        measurements["episode_list_seconds"].append(time.perf_counter() - started_at)
+        flow.anilist
+        measurements["anilist_ready_seconds"].append(time.perf_counter() - started_at)
+        flow.reddit
+        measurements["reddit_ready_seconds"].append(time.perf_counter() - started_at)
+    return {name: summarize(samples) for name, samples in measurements.items()}
+
+
+def benchmark_get_episodes(args) -> list[dict]:
+    """Cold listing with a full sync and warm listing with an incremental one"""
+    results = []
+    for torrent_count in args.torrents:
+        cold, warm = [], []
+        for _ in range(args.repeat):
+            services = Services(args, torrent_count)
+            qbittorrent = Qbittorrent()
+            started_at = time.perf_counter()
+            episodes = qbittorrent.get_episodes()
+            cold.append(time.perf_counter() - started_at)
+            cold_requests = services.get_request_counts()["qbittorrent"]
+
+            services.reset_request_counts()
+            started_at = time.perf_counter()
+            qbittorrent.get_episodes()
+            warm.append(time.perf_counter() - started_at)
+            warm_requests = services.get_request_counts()["qbittorrent"]
+        results.append(
+            {
+                "torrents": torrent_count,
+                "episodes": len(episodes),
+                "cold_seconds": summarize(cold),
+                "warm_seconds": summarize(warm),
+                "cold_requests": cold_requests,
+                "warm_requests": warm_requests,
+            }
+        )
+    return results
+
+
+def benchmark_prefetch(args) -> dict:
+    """Latency from listing the episodes until each one's data is prefetched"""
+    services = Services(args, args.prefetch_torrents)
+    flow = TimedAniFlow()
+    episodes = flow.qbittorrent.get_episodes()
+    flow.anilist
+    wait_for_harvest(flow.reddit)
+
+    services.reset_request_counts()
+    flow.expected_prefetches = len(episodes)
+    started_at = time.perf_counter()
+    flow.prefetcher.submit_all(episodes)
+    completed = flow.all_prefetched.wait(args.timeout)
+    latencies = sorted(
+        prefetched_at - started_at for prefetched_at in flow.prefetched_at.values()
+    )
+    return {
+        "episodes": len(episodes),
+        "completed": completed,
+        "errors": flow.prefetch_errors,
+        "resolved": sum(1 for episode in episodes if episode.anilist_entry),
+        "first_seconds": latencies[0] if latencies else None,
+        "median_seconds": statistics.median(latencies) if latencies else None,
+        "p95_seconds": (
+            statistics.quantiles(latencies, n=20)[-1] if len(latencies) > 1 else None
+        ),
+        "total_seconds": latencies[-1] if latencies else None,
+        "requests": services.get_request_counts(),
+    }
+
+
+def benchmark_graph(args) -> list[dict]:
+    """Cost of building a franchise from AniList and locating episodes in it"""
+    services = Services(args, 0)
+    anilist = AniList()
+    results = []
+    for franchise_length in args.franchise_lengths:
+        services.anilist.franchise_length = franchise_length
+        ids = [get_franchise_id(0) + season for season in range(franchise_length)]
+        build, lookups = [], []
+        for _ in range(args.repeat):
+            services.reset_request_counts()
+            started_at = time.perf_counter()
+            graph = {}
+            head_id = anilist._build_graph(ids, graph)
+            franchise = Franchise.from_graph(graph, head_id)
+            build.append(time.perf_counter() - started_at)
+            requests = services.get_request_counts()["anilist"]
+
+            episode_count = franchise_length * EPISODES_PER_SEASON
+            started_at = time.perf_counter()
+            for absolute_episode_number in range(1, episode_count + 1):
+                franchise.locate(absolute_episode_number)
+            lookups.append((time.perf_counter() - started_at) / episode_count)
+        results.append(
+            {
+                "franchise_length": franchise_length,
+                "entries": len(franchise.entries),
+                "build_seconds": summarize(build),
+                "build_requests": requests,
+                "locate_seconds": summarize(lookups),
+            }
+        )
+    return results
+
+
+BENCHMARKS = {
+    "startup": benchmark_startup,
+    "get_episodes": benchmark_get_episodes,
+    "prefetch": benchmark_prefetch,
+    "graph": benchmark_graph,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="benchmarks",
+        description="Benchmarks AniFlow against local stand-ins for every external service",
+    )
+    parser.add_argument(
+        "benchmarks",
+        nargs="*",
+        help=f"any of {', '.join(BENCHMARKS)} (default: all)",
+    )
+    parser.add_argument("--torrents", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--prefetch-torrents", type=int, default=100)
+    parser.add_argument("--franchise-lengths", type=int, nargs="+", default=[1, 10, 50, 100])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--anilist-latency-ms", type=float, default=50)
+    parser.add_argument("--anilist-rate-limit", type=int, default=90)
+    parser.add_argument(
+        "--latency-ms", type=float, default=5, help="latency of the other services"
+    )
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--output", type=Path, help="write the JSON results here")
+    args = parser.parse_args()
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(sorted(unknown))}")
+
+    results = {}
+    for name in args.benchmarks or BENCHMARKS:
+        print(f"Running {name}", file=sys.stderr)
+        results[name] = BENCHMARKS[name](args)
+
+    report = json.dumps(
+        {
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "arguments": {
+                name: str(value) if isinstance(value, Path) else value
+                for name, value in vars(args).items()
+            },
+            "results": results,
+        },
+        indent=2,
+    )
+    if args.output:
+        args.output.write_text(report)
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+import json
+import time
+import zlib
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from threading import Lock, Thread
+from urllib.parse import parse_qsl, urlsplit, urlunsplit
+
+from requests.adapters import BaseAdapter
+
+EPISODES_PER_SEASON = 12
+# Every SEASONAL_SHOW_RATIO-th show uses absolute episode numbers, so it needs TMDB
+SEASONAL_SHOW_RATIO = 5
+ABSOLUTE_SEASON = 9
+FRANCHISE_ID_STRIDE = 1000
+TMDB_ID_OFFSET = 500_000
+
+
+def get_show_title(show: int) -> str:
+    return f"Benchmark Show {show}"
+
+
+def get_franchise_id(show: int) -> int:
+    """Returns the AniList id of the first season of a show that uses absolute numbering"""
+    return (show + 1) * FRANCHISE_ID_STRIDE
+
+
+def uses_absolute_numbering(show: int) -> bool:
+    return show % SEASONAL_SHOW_RATIO == SEASONAL_SHOW_RATIO - 1
+
+
+class FakeService(ThreadingHTTPServer):
+    """Local HTTP server standing in for an external service"""
+
+    daemon_threads = True
+
+    def __init__(self, latency: float = 0) -> None:
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.latency = latency
+        self.request_count = 0
+        self._count_lock = Lock()
+        Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def count_request(self):
+        with self._count_lock:
+            self.request_count += 1
+
+    def respond(self, method: str, path: str, params: dict, body: bytes):
+        """Returns the status code, headers and JSON payload of the response"""
+        return 404, {}, {"error": "Not found"}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Keeps connections alive like the real services
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        params = dict(parse_qsl(url.query))
+        if self.headers.get("Content-Type", "").startswith(
+            "application/x-www-form-urlencoded"
+        ):
+            params.update(parse_qsl(body.decode()))
+
+        self.server.count_request()
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        status, headers, payload = self.server.respond(
+            self.command, url.path.rstrip("/"), params, body
+        )
+
+        if isinstance(payload, str):
+            content, content_type = payload.encode(), "text/plain"
+        else:
+            content, content_type = json.dumps(payload).encode(), "application/json"
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_POST = do_GET
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeQbittorrent(FakeService):
+    """qBittorrent WebUI with one synthetic single-file torrent per episode.
+
+    The episode files are created empty under save_path since only completed
+    files that exist on disk are listed.
+    """
+
+    WEB_API_VERSION = "2.9.3"
+
+    def __init__(self, torrent_count: int, save_path: Path, latency: float = 0) -> None:
+        self.save_path = save_path
+        self.torrents = {}
+        self.files = {}
+        save_path.mkdir(parents=True, exist_ok=True)
+        for i in range(torrent_count):
+            show, episode = divmod(i, EPISODES_PER_SEASON)
+            episode += 1
+            if uses_absolute_numbering(show):
+                episode += ABSOLUTE_SEASON * EPISODES_PER_SEASON
+            name = f"[Bench] {get_show_title(show)} - {episode:02d} [1080p].mkv"
+            (save_path / name).touch()
+            torrent_hash = f"{zlib.crc32(name.encode()):08x}".ljust(40, "0")
+            self.torrents[torrent_hash] = {
+                "name": name,
+                "category": "Anime",
+                "progress": 1,
+                "state": "uploading",
+                "save_path": str(save_path),
+            }
+            self.files[torrent_hash] = [
+                {"index": 0, "name": name, "progress": 1, "priority": 1, "size": 0}
+            ]
+        super().__init__(latency)
+
+    def respond(self, method, path, params, body):
+        match path:
+            case "/api/v2/auth/login":
+                return 200, {"Set-Cookie": "SID=benchmark; path=/"}, "Ok."
+            case "/api/v2/app/version":
+                return 200, {}, "v4.6.0"
+            case "/api/v2/app/webapiVersion":
+                return 200, {}, self.WEB_API_VERSION
+            case "/api/v2/sync/maindata":
+                rid = int(params.get("rid", 0))
+                if rid:
+                    return 200, {}, {"rid": rid + 1}
+                return 200, {}, {"rid": 1, "full_update": True, "torrents": self.torrents}
+            case "/api/v2/torrents/files":
+                return 200, {}, self.files.get(params.get("hash"), [])
+        return super().respond(method, path, params, body)
+
+
+class FakeAniList(FakeService):
+    """AniList GraphQL endpoint that enforces a per-minute rate limit.
+
+    Searches return a single season of EPISODES_PER_SEASON episodes for the
+    title. Ids from get_franchise_id are linked to the franchise_length - 1
+    ids that follow them as sequels.
+    """
+
+    PAGE_SIZE = 50
+
+    def __init__(
+        self,
+        latency: float = 0,
+        requests_per_minute: int = 90,
+        franchise_length: int = ABSOLUTE_SEASON + 1,
+    ) -> None:
+        self.requests_per_minute = requests_per_minute
+        self.franchise_length = franchise_length
+        self.rate_limited_count = 0
+        self._requested_at = deque()
+        self._rate_limit_lock = Lock()
+        super().__init__(latency)
+
+    def respond(self, method, path, params, body):
+        remaining = self._take_request()
+        headers = {
+            "X-RateLimit-Limit": str(self.requests_per_minute),
+            "X-RateLimit-Remaining": str(max(remaining, 0)),
+        }
+        if remaining < 0:
+            headers["Retry-After"] = "1"
+            return 429, headers, {"errors": [{"message": "Too Many Requests."}]}
+
+        variables = json.loads(body).get("variables") or {}
+        data = {}
+        for name, title in variables.items():
+            if name.startswith("search"):
+                data[name] = {"results": [self._get_search_result(title)]}
+        if "ids" in variables:
+            start = (variables.get("page", 1) - 1) * self.PAGE_SIZE
+            ids = variables["ids"][start : start + self.PAGE_SIZE]
+            data["Page"] = {
+                "pageInfo": {"hasNextPage": start + self.PAGE_SIZE < len(variables["ids"])},
+                "media": [self._get_media(id) for id in ids],
+            }
+        return 200, headers, {"data": data}
+
+    def _take_request(self) -> int:
+        """Returns the requests left in the current minute, negative if over the limit"""
+        now = time.monotonic()
+        with self._rate_limit_lock:
+            while self._requested_at and self._requested_at[0] < now - 60:
+                self._requested_at.popleft()
+            if len(self._requested_at) >= self.requests_per_minute:
+                self.rate_limited_count += 1
+                return -1
+            self._requested_at.append(now)
+            return self.requests_per_minute - len(self._requested_at)
+
+    def _get_search_result(self, title: str) -> dict:
+        return {
+            # Kept below the franchise ids
+            "id": zlib.crc32(title.encode()) % (FRANCHISE_ID_STRIDE - 1) + 1,
+            "title": {"romaji": title, "english": None},
+            "synonyms": [],
+            "episodes": EPISODES_PER_SEASON,
+            "siteUrl": f"{self.url}/anime/{title}",
+            "relations": {"edges": [], "nodes": []},
+        }
+
+    def _get_media(self, id: int) -> dict:
+        season = id % FRANCHISE_ID_STRIDE
+        relations = []
+        if season > 0:
+            relations.append(("PREQUEL", id - 1))
+        if season < self.franchise_length - 1:
+            relations.append(("SEQUEL", id + 1))
+        return {
+            "id": id,
+            "title": {"romaji": f"Franchise {id // FRANCHISE_ID_STRIDE} Part {season + 1}"},
+            "synonyms": [],
+            "episodes": EPISODES_PER_SEASON,
+            "siteUrl": f"{self.url}/anime/{id}",
+            "relations": {
+                "edges": [{"relationType": type} for type, _ in relations],
+                "nodes": [{"id": id} for _, id in relations],
+            },
+        }
+
+
+class FakeTmdb(FakeService):
+    """TMDB API where each show has ABSOLUTE_SEASON + 1 seasons"""
+
+    def respond(self, method, path, params, body):
+        if path == "/3/search/tv":
+            show = int(params.get("query", "").rsplit(" ", 1)[-1])
+            return 200, {}, {"results": [{"id": TMDB_ID_OFFSET + show}]}
+        if path.startswith("/3/tv/"):
+            return 200, {}, {
+                "seasons": [
+                    {
+                        "name": f"Season {season}",
+                        "season_number": season,
+                        "episode_count": EPISODES_PER_SEASON,
+                    }
+                    for season in range(1, ABSOLUTE_SEASON + 2)
+                ]
+            }
+        return super().respond(method, path, params, body)
+
+    @staticmethod
+    def get_anime_id_db(show_count: int) -> list[dict]:
+        """Returns the anime id database entries mapping each show to its AniList franchise"""
+        return [
+            {
+                "anilist_id": get_franchise_id(show) + season,
+                "themoviedb_id": TMDB_ID_OFFSET + show,
+                "type": "TV",
+            }
+            for show in range(show_count)
+            for season in range(ABSOLUTE_SEASON + 1)
+        ]
+
+
+class FakeReddit(FakeService):
+    """Reddit OAuth API with an episode discussion for every synthetic episode"""
+
+    def __init__(self, show_count: int, latency: float = 0) -> None:
+        self.discussions = [
+            {
+                "id": f"bench{show}x{episode}",
+                "name": f"t3_bench{show}x{episode}",
+                "title": f"{get_show_title(show)} - Episode {episode} discussion",
+                "url": f"https://redd.it/bench{show}x{episode}",
+                "created_utc": time.time() - show * EPISODES_PER_SEASON - episode,
+                "link_flair_text": "Episode",
+            }
+            for show in range(show_count)
+            for episode in range(1, EPISODES_PER_SEASON + 1)
+        ]
+        super().__init__(latency)
+
+    def respond(self, method, path, params, body):
+        if path == "/api/v1/access_token":
+            return 200, {}, {
+                "access_token": "benchmark",
+                "expires_in": 3600,
+                "scope": "*",
+                "token_type": "bearer",
+            }
+        if path in ("/r/anime/new", "/r/anime/search"):
+            limit = int(params.get("limit", 25))
+            children = [
+                {"kind": "t3", "data": discussion}
+                for discussion in self.discussions[:limit]
+            ]
+            return 200, {}, {
+                "kind": "Listing",
+                "data": {"children": children, "after": None, "before": None},
+            }
+        if path.startswith("/api/vote"):
+            return 200, {}, {}
+        return super().respond(method, path, params, body)
+
+
+class RedirectAdapter(BaseAdapter):
+    """Sends requests for an external host to a fake service through another adapter"""
+
+    def __init__(self, service: FakeService, adapter: BaseAdapter) -> None:
+        super().__init__()
+        self.service = service
+        self.adapter = adapter
+
+    def send(self, request, **kwargs):
+        target = urlsplit(self.service.url)
+        request.url = urlunsplit(
+            urlsplit(request.url)._replace(scheme=target.scheme, netloc=target.netloc)
+        )
+        return self.adapter.send(request, **kwargs)
+
+    def close(self):
+        self.adapter.close()
+
+
+def redirect(session, routes: dict[str, FakeService]):
+    """Mounts adapters on the session that send requests for each URL prefix to its fake service"""
+    adapter = session.get_adapter("http://")
+    for prefix, service in routes.items():
+        session.mount(prefix, RedirectAdapter(service, adapter))